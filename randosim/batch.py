@@ -0,0 +1,227 @@
+import random
+
+import numpy as np
+
+from .compiled import bits
+from .simulation import QualitativeCategories
+
+### Batch engine
+#
+# Runs every run of one simulation on one choices file in lockstep. State is
+# kept as boolean matrices with one row per run; requirement checks, the
+# unlock closure and end-state detection are matrix operations over all rows
+# still in progress.
+
+def _item_matrix(size, mapping, target=None):
+    m = np.zeros((size, size), dtype=np.float32)
+    for (i, value) in mapping.items():
+        if target is None:
+            for j in bits(value):
+                m[i, j] = 1
+        else:
+            m[i, value] = 1
+    return m
+
+class BatchCategories:
+    # One qualitative report's compiled categories (QualitativeCategories) as
+    # column lists over the condition matrix [chosen unlockables | found items | always-false].
+    def __init__(self, report, compiled_base, size):
+        self.label = report["label"]
+        categories = QualitativeCategories(report["categories"])
+        self.names = categories.names
+        unlockable_count = len(compiled_base.unlockable_names)
+        false_col = unlockable_count + size
+
+        columns = []
+        for (bit, condition) in enumerate(categories.conditions):
+            i = None
+            if (categories.never >> bit) & 1:
+                pass
+            elif condition["type"] == "made-choice":
+                i = compiled_base.ids.get(condition["choice"])
+                if i is not None and i >= unlockable_count:
+                    i = None
+            else:
+                i = compiled_base.ids.get(condition["findable"])
+                if i is not None:
+                    i = unlockable_count + i if i < size else None
+            columns.append(false_col if i is None else i)
+
+        def cols(mask):
+            return [columns[bit] for bit in bits(mask)]
+
+        self.compiled = []
+        for k in range(len(self.names)):
+            self.compiled.append((
+                cols(categories.and_masks[k]),
+                cols(categories.and_not_masks[k]),
+                cols(categories.or_masks[k]),
+                cols(categories.or_not_masks[k]),
+                categories.has_or[k],
+            ))
+
+    def matches(self, conditions):
+        rows = conditions.shape[0]
+        out = np.zeros((rows, len(self.compiled)), dtype=bool)
+        for (k, (ands, and_nots, ors, or_nots, has_or)) in enumerate(self.compiled):
+            m = conditions[:, ands].all(axis=1)
+            if and_nots:
+                m &= ~conditions[:, and_nots].any(axis=1)
+            if has_or:
+                m &= conditions[:, ors].any(axis=1) | (~conditions[:, or_nots]).any(axis=1)
+            out[:, k] = m
+        return out
+
+class BatchSimulation:
+    def __init__(self, compiled, sim, strategy, reports=None):
+        self.compiled = compiled
+        self.sim = sim
+        self.strategy = strategy
+        if reports is None:
+            reports = [r for r in sim["reports"] if r.get("type", None) == "qualitative"]
+
+        base = compiled.compiled_base
+        self.unlockable_count = len(base.unlockable_names)
+        self.size = len(base.names)
+        size = self.size
+        self.unlock_map = _item_matrix(size, base.unlock_masks)
+        self.findable_unlock_map = _item_matrix(size, base.findable_unlock_masks)
+        self.find_map = _item_matrix(size, compiled.location_finds, target=True)
+
+        clauses = []
+        owners = []
+        for (u, requirement) in enumerate(base.requirements):
+            for c in requirement:
+                clauses.append([(c >> i) & 1 for i in range(size)])
+                owners.append(u)
+        # float32 throughout so the products below go through BLAS
+        self.clauses = np.array(clauses, dtype=np.float32).reshape(len(clauses), size)
+        self.clause_sizes = self.clauses.sum(axis=1)
+        self.clause_owners = np.zeros((len(clauses), self.unlockable_count), dtype=np.float32)
+        self.clause_owners[np.arange(len(clauses)), owners] = 1
+
+        self.end_ids = [base.ids[e] for e in sim["end-states"] if e in base.ids]
+        self.first_choices = [c for c in strategy.first_choice_ids if c < self.unlockable_count]
+        self.weights = np.ones(self.unlockable_count)
+        for (i, w) in strategy.weight_of.items():
+            if i < self.unlockable_count:
+                self.weights[i] = w
+        self.reports = [BatchCategories(r, base, size) for r in reports]
+        # found items in the order the scalar engine's found hooks see them
+        # (CompiledChoices.found_order), and how many time stamps each event
+        # gets, one per findable found in it
+        extra = compiled.extra_rank
+        self.found_perm = np.array(sorted(range(size), key=lambda i: (1, extra[i]) if i in extra else (0, i)))
+        self.time_scale = size + 1
+
+    def _close(self, unlocks, found):
+        while True:
+            u = unlocks.astype(np.float32)
+            new_unlocks = unlocks | ((u @ self.unlock_map) > 0) | ((found.astype(np.float32) @ self.findable_unlock_map) > 0)
+            new_found = found | ((u @ self.find_map) > 0)
+            if (new_unlocks == unlocks).all() and (new_found == found).all():
+                return (unlocks, found)
+            (unlocks, found) = (new_unlocks, new_found)
+
+    def _reachable(self, unlocks, found):
+        got = (unlocks | found).astype(np.float32)
+        satisfied = (got @ self.clauses.T) == self.clause_sizes
+        return (satisfied.astype(np.float32) @ self.clause_owners) > 0
+
+    def _check_reports(self, rows, chosen, found, latched, time):
+        # chosen and found are already just the rows'
+        if not self.reports:
+            return
+        conditions = np.concatenate([chosen, found, np.zeros((len(rows), 1), dtype=bool)], axis=1)
+        for (r, report) in enumerate(self.reports):
+            newly = report.matches(conditions) & (latched[r][rows] < 0)
+            if newly.any():
+                latched[r][rows] = np.where(newly, time, latched[r][rows])
+
+    def _check_found(self, rows, chosen, before, after, latched, event):
+        # like the scalar found hooks: the findables new in after are added
+        # one at a time, in found order, checking the reports after each
+        if not self.reports:
+            return
+        perm = self.found_perm
+        new = (after & ~before)[:, perm]
+        position = np.cumsum(new, axis=1)
+        most = int(position[:, -1].max()) if len(rows) else 0
+        for j in range(most):
+            partial = before.copy()
+            partial[:, perm] |= new & (position <= j + 1)
+            self._check_reports(rows, chosen, partial, latched, event * self.time_scale + j)
+
+    def run(self, seeds):
+        # one random.Random stream per run, drawn from exactly as the scalar
+        # engine's weighted_choice does, so both engines make the same choices
+        n = len(seeds)
+        rngs = [random.Random(seed) for seed in seeds]
+        u = self.unlockable_count
+        unlocks = np.zeros((n, self.size), dtype=bool)
+        found = np.zeros((n, self.size), dtype=bool)
+        for f in self.compiled.initial_found:
+            found[:, f] = True
+        chosen = np.zeros((n, u), dtype=bool)
+        history = np.full((n, u), -1, dtype=np.int32)
+        steps = np.zeros(n, dtype=np.int32)
+        # time at which each category first matched, -1 while it hasn't:
+        # event (0 for the start, then 2 per choice: the choice, then what it
+        # unlocked) times time_scale, plus the findable's place in the event
+        latched = [np.full((n, len(r.names)), -1, dtype=np.int64) for r in self.reports]
+
+        (unlocks, found) = self._close(unlocks, found)
+        everything = np.arange(n)
+        self._check_found(everything, chosen, np.zeros_like(found), found, latched, 0)
+
+        step = 0
+        while True:
+            active = np.flatnonzero(~unlocks[:, self.end_ids].any(axis=1))
+            if len(active) == 0:
+                break
+            a_unlocks = unlocks[active]
+            a_found = found[active]
+            available = self._reachable(a_unlocks, a_found) & ~a_unlocks[:, :u]
+
+            choice = np.full(len(active), -1, dtype=np.int64)
+            for c in self.first_choices:
+                pick = (choice < 0) & available[:, c]
+                choice[pick] = c
+            undecided = np.flatnonzero(choice < 0)
+            if len(undecided) > 0:
+                options = available[undecided]
+                if not options.any(axis=1).all():
+                    raise IndexError('Cannot choose from an empty sequence')
+                cumulative = np.cumsum(options * self.weights, axis=1)
+                r = np.array([rngs[i].random() for i in active[undecided]]) * cumulative[:, -1]
+                over = cumulative > r[:, None]
+                picked = over.argmax(axis=1)
+                # like bisect with hi set to the last option, fall back to the last one
+                last = u - 1 - options[:, ::-1].argmax(axis=1)
+                choice[undecided] = np.where(over.any(axis=1), picked, last)
+
+            chosen[active, choice] = True
+            a_unlocks[np.arange(len(active)), choice] = True
+            history[active, steps[active]] = choice
+            steps[active] += 1
+            step += 1
+            a_chosen = chosen[active]
+            self._check_reports(active, a_chosen, a_found, latched, 2 * step * self.time_scale)
+
+            found_before = a_found
+            (a_unlocks, a_found) = self._close(a_unlocks, a_found)
+            unlocks[active] = a_unlocks
+            found[active] = a_found
+            self._check_found(active, a_chosen, found_before, a_found, latched, 2 * step + 1)
+
+        names = self.compiled.compiled_base.names
+        results = []
+        for i in range(n):
+            run = {"choices": [names[c] for c in history[i, :steps[i]]], "choice_count": int(steps[i]), "seed": seeds[i]}
+            for (r, report) in enumerate(self.reports):
+                times = latched[r][i]
+                matched = [k for k in range(len(report.names)) if times[k] >= 0]
+                matched.sort(key=lambda k: (times[k], k))
+                run[report.label] = [report.names[k] for k in matched]
+            results.append(run)
+        return results
@@ -0,0 +1,146 @@
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import queue as queues
+import resource
+import sys
+import time
+import traceback
+
+from . import generate
+from . import simulation
+from .parse_file import parse_file
+
+### Benchmarks
+#
+# Throughput of the engine on real base/sim files with generated choices
+# (generate.GeneratedChoices, beatable for each sim's end states).
+# Each (base, sim, engine, workers) configuration runs end-to-end in a fresh
+# child process, so its peak RSS, and its largest worker's, are its own.
+# Per-phase timings come from a separate serial pass with the "instrument"
+# opt, since timing every step itself costs time: choose, closure (the whole
+# advance, memo hits included), report hooks and aggregation, as analyze
+# --instrument reports them.
+
+def _with_count(sim, count):
+    if count is None:
+        return sim
+    sim = dict(sim)
+    sim["simulations"] = [dict(s, count=count) for s in sim["simulations"]]
+    return sim
+
+class _RunCounter:
+    # stands in for an output writer, to count runs and steps as they arrive
+    def __init__(self):
+        self.runs = 0
+        self.steps = 0
+
+    def add(self, file_id, simulation_id, run, reports):
+        self.runs += 1
+        self.steps += reports["choice_count"]
+
+def _measure(config, queue):
+    # in the child: sends back ("result", measurements), or ("error", the
+    # traceback) so the parent can fail instead of waiting forever
+    try:
+        queue.put(("result", _measure_config(config)))
+    except BaseException:
+        queue.put(("error", traceback.format_exc()))
+
+def _measure_config(config):
+    base = config["base_data"]
+    sim = config["sim_data"]
+    opts = {"engine": config["engine"], "seed": 0}
+    counter = _RunCounter()
+    devnull = open(os.devnull, 'w')
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(devnull):
+        if config["workers"] == 0:
+            simulator = simulation.RandomizerSimulator(config["files"], base, sim, opts=opts, output=counter)
+            simulator.run()
+        else:
+            opts["processes"] = config["workers"]
+            with simulation.worker_pool([base], [sim], config["files"], opts) as pool:
+                simulator = simulation.RandomizerSimulator(config["files"], base, sim, pool=pool, opts=opts, output=counter)
+                simulator.run()
+    json.dumps(simulator.reports)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is a peak, not a sum: for RUSAGE_CHILDREN it's the largest
+    # of the workers, so the two are reported apart rather than added up
+    return {"runs": counter.runs, "steps": counter.steps, "seconds": seconds,
+            "runs_per_sec": counter.runs / seconds, "steps_per_sec": counter.steps / seconds,
+            "peak_rss_main_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "peak_rss_largest_worker_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+def _in_child(config):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(config, queue))
+    process.start()
+    while True:
+        try:
+            (kind, value) = queue.get(timeout=1)
+            break
+        except queues.Empty:
+            # died without sending anything (killed, or out of memory)
+            if not process.is_alive() and queue.empty():
+                raise RuntimeError("Benchmark process for %s / %s exited with code %s" % (config["base"], config["sim"], process.exitcode))
+    process.join()
+    if kind == "error":
+        raise RuntimeError("Benchmark of %s / %s failed:\n%s" % (config["base"], config["sim"], value))
+    return value
+
+def _phases(base, sim, files):
+    devnull = open(os.devnull, 'w')
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(devnull):
+        simulator = simulation.RandomizerSimulator(files, base, sim, opts={"seed": 0, "instrument": True})
+        simulator.run()
+    phases = dict(simulator.reports["instruments"]["timers"])
+    serialize_start = time.perf_counter()
+    json.dumps(simulator.reports)
+    phases["serialization"] = time.perf_counter() - serialize_start
+    phases["total"] = time.perf_counter() - start
+    return phases
+
+def run_bench(bases, sims, seeds=20, count=None, workers=[0, 1], engines=["scalar"], phases=True, out=sys.stdout):
+    results = []
+    for base_file in bases:
+        with open(base_file, 'r') as f:
+            base = parse_file(f)
+        for sim_file in sims:
+            with open(sim_file, 'r') as f:
+                sim = _with_count(parse_file(f), count)
+            files = generate.GeneratedChoices(base, seeds, 0, sim["end-states"])
+            config = {"base": base_file, "sim": sim_file, "base_data": base, "sim_data": sim, "files": files}
+            for engine in engines:
+                for w in workers:
+                    config.update({"engine": engine, "workers": w})
+                    result = {"base": base_file, "sim": sim_file, "engine": engine, "workers": w}
+                    result.update(_in_child(config))
+                    results.append(result)
+                    print("%-32s %-28s %-6s workers=%-2d %8.0f runs/s %9.0f steps/s  peak RSS %8d KB main %8d KB largest worker" % (
+                        os.path.basename(base_file), os.path.basename(sim_file), engine, w,
+                        result["runs_per_sec"], result["steps_per_sec"], result["peak_rss_main_kb"], result["peak_rss_largest_worker_kb"]), file=out)
+            if phases:
+                timings = _phases(base, sim, files)
+                results.append({"base": base_file, "sim": sim_file, "phases": timings})
+                print("    phases (serial): " + ", ".join("%s %.3fs" % (k, v) for (k, v) in timings.items()), file=out)
+    return results
+
+def _key(result):
+    return (result["base"], result["sim"], result.get("engine"), result.get("workers"), "phases" in result)
+
+def compare(results, previous, out=sys.stdout):
+    before = {_key(r): r for r in previous}
+    for r in results:
+        old = before.get(_key(r))
+        if old is None or "phases" in r:
+            continue
+        print("%-32s %-28s %-6s workers=%-2d runs/s %8.0f -> %8.0f (x%.2f)" % (
+            os.path.basename(r["base"]), os.path.basename(r["sim"]), r["engine"], r["workers"],
+            old["runs_per_sec"], r["runs_per_sec"], r["runs_per_sec"] / old["runs_per_sec"]), file=out)
+
+def default_files(pattern):
+    return sorted(glob.glob(pattern))
@@ -0,0 +1,33 @@
+import hashlib
+import json
+import sqlite3
+
+### Result cache
+#
+# Finished (choices, simulation) units in an sqlite database, under a hash
+# of everything their results depend on (see SimulationRun.cache_key). Each
+# unit is committed as soon as it's done, so an interrupted analyze keeps
+# what it finished and a rerun only does the rest.
+
+def unit_key(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResultCache:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS units (key TEXT PRIMARY KEY, choices TEXT, simulation TEXT, result TEXT)")
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute("SELECT result FROM units WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, choices_name, simulation_label, result):
+        self.db.execute("INSERT OR REPLACE INTO units (key, choices, simulation, result) VALUES (?, ?, ?, ?)",
+                        (key, choices_name, simulation_label, json.dumps(result)))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -1,50 +1,195 @@
 import argparse
+import contextlib
 import json
-import multiprocessing
 import os
 import sys
 
 from . import summary
-from . import simulation
 from .parse_file import parse_file
 
 
-def cmdline():
+def make_parser():
     parser = argparse.ArgumentParser(description="Simulate playing through a randomized game, gathering statistics.")
-    sub = parser.add_subparsers()
+    sub = parser.add_subparsers(dest='command')
 
     analyze = sub.add_parser('analyze', help="Analyze some files")
-    analyze.add_argument('-b', '--base', help="The base game description file", type=argparse.FileType('r'), required=True)
-    analyze.add_argument('-s', '--simulation', help="The file specifying the simulation to run", type=argparse.FileType('r'), required=True)
-    #analyze.add_argument('-d', '--database', help="The sqlite database file to store results in.", required=False)
+    analyze.add_argument('-b', '--base', help="The base game description file; repeat to give several, which with several simulation files runs every base against every simulation file and compares them", type=argparse.FileType('r'), action='append', required=True)
+    analyze.add_argument('-s', '--simulation', help="The file specifying the simulation to run; repeat to give several", type=argparse.FileType('r'), action='append', required=True)
+    analyze.add_argument('-e', '--engine', help="The engine to run simulations with, unless the simulation sets its own 'engine'", choices=['scalar', 'batch'], default='scalar')
+    analyze.add_argument('-x', '--exact', help="Work out exact outcome probabilities instead of sampling, for simulations that don't set their own 'exact'", action='store_true')
+    analyze.add_argument('--max-states', help="With --exact, sample any simulation with more states than this after all (default: 100000)", type=int)
+    analyze.add_argument('--target-ci', help="Run in batches until every category's 95%% interval is at most this either side of its percentage, for simulations that don't set their own 'target-ci'", type=float)
+    analyze.add_argument('--max-count', help="With --target-ci, stop after this many runs even if not there yet (default: each simulation's count)", type=int)
+    analyze.add_argument('--batch-size', help="With --target-ci, runs per batch between checks (default: 100)", type=int)
+    analyze.add_argument('--memo-size', help="States to remember per choices file, shared by all its simulations and runs (default: 65536; 0 turns it off)", type=int)
+    analyze.add_argument('--instrument', help="Count and time each phase of the simulations, in an 'instruments' section per simulation, file and overall", action='store_true')
+    analyze.add_argument('--profile', help="Profile the run (workers included) with cProfile, writing the merged stats to this file and the top entries to stderr")
+    analyze.add_argument('--progress', help="Print runs done, runs/sec and ETA, overall and per file, to stderr at most every SECONDS (default: 10)", type=float, nargs='?', const=10, metavar='SECONDS')
+    analyze.add_argument('--partial-summaries', help="With --progress, also print each report's percentages so far every SECONDS", type=float, metavar='SECONDS')
+    analyze.add_argument('-j', '--processes', help="Number of worker processes, 0 to run in this process (default: CPU count minus 2, or 0 for small jobs)", type=int)
+    analyze.add_argument('--chunk-size', help="Runs per work unit sent to a worker (default: chosen from the total run count)", type=int)
+    analyze.add_argument('--seed', help="Master seed for the runs of simulations that don't set their own 'seed'", type=int)
+    analyze.add_argument('--keep-raw', help="Keep every run's reports in the output, not just the summaries", action='store_true')
+    analyze.add_argument('-o', '--output', help="Write one row per run to this columnar .npz file (needs numpy); stdout keeps the summary JSON")
+    analyze.add_argument('--trace', help="With --output, also record each run's steps (available count, findables gained), for replay; runs on the scalar engine", action='store_true')
+    analyze.add_argument('-g', '--generate', help="Also simulate this many choices mappings generated from the (first) base file", type=int, default=0)
+    analyze.add_argument('--generate-seed', help="Seed for --generate; generated mapping i depends only on this and i", type=int, default=0)
+    analyze.add_argument('--allow-unbeatable', help="Also generate mappings that can't reach any of the (first) simulation's end states; runs on them get stuck and fail", action='store_true')
+    analyze.add_argument('--extra-findables', help="Names to place besides the base's findables when generating (default: whatever requirements mention but the base doesn't define)", nargs='+')
+    analyze.add_argument('--write-choices', help="Write every choices mapping used to this file, one JSON object per line, instead of simulating")
+    analyze.add_argument('-d', '--database', help="The sqlite database file to store results in, and reuse them from on later runs", required=False)
     # string for this one, we'll open each one in the loop
-    analyze.add_argument('choices', help="The file(s) describing randomized choices to use for simulating", nargs='*')
+    analyze.add_argument('choices', help="The file(s) describing randomized choices to use for simulating; .jsonl files hold many, as written by --write-choices", nargs='*')
+
+    bench = sub.add_parser('bench', help="Benchmark the simulation engine on base and simulation files, with generated choices")
+    bench.add_argument('-b', '--base', help="Base game description file(s) (default: bases/*.json)", nargs='+')
+    bench.add_argument('-s', '--simulation', help="Simulation file(s) (default: sims/*.json)", nargs='+')
+    bench.add_argument('-n', '--seeds', help="Number of choices files to generate per base and simulation", type=int, default=20)
+    bench.add_argument('-c', '--count', help="Override every simulation's run count", type=int)
+    bench.add_argument('-w', '--workers', help="Worker counts to measure; 0 runs in-process without a pool", type=int, nargs='+', default=[0, 1, 2, 4])
+    bench.add_argument('-e', '--engine', help="Engines to measure", choices=['scalar', 'batch'], nargs='+', default=['scalar'])
+    bench.add_argument('--no-phases', help="Skip the instrumented serial pass that times each phase", action='store_true')
+    bench.add_argument('--save', help="Write the results to this JSON file")
+    bench.add_argument('--compare', help="Compare runs/sec against results saved earlier with --save", type=argparse.FileType('r'))
 
+    replay = sub.add_parser('replay', help="Work out a simulation file's reports over runs recorded with analyze --output --trace, without simulating")
+    replay.add_argument('-s', '--simulation', help="The simulation file whose reports to work out (its simulations are ignored)", type=argparse.FileType('r'), required=True)
+    replay.add_argument('traces', help="The .npz file(s) written by analyze --output --trace", nargs='+')
+    return parser
+
+def cmdline():
+    parser = make_parser()
     args = parser.parse_args()
-    base = parse_file(args.base)
-    sim = parse_file(args.simulation)
-    if len(args.choices) == 0:
-        summary.summarize_options(base)
+    if args.command == 'bench':
+        from . import bench as benchmarks
+        results = benchmarks.run_bench(args.base or benchmarks.default_files("bases/*.json"),
+                                       args.simulation or benchmarks.default_files("sims/*.json"),
+                                       seeds=args.seeds, count=args.count, workers=args.workers,
+                                       engines=args.engine, phases=not args.no_phases)
+        if args.save is not None:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=1)
+        if args.compare is not None:
+            benchmarks.compare(results, json.load(args.compare))
+        return
+    if args.command == 'replay':
+        from . import replay as replays
+        reports = replays.replay(args.traces, parse_file(args.simulation))
+        print(json.dumps(reports))
+        import pprint
+        for (label, summaries) in [("<all simulations>", reports["summary"])] + [(s, reports["simulations"][s]["summary"]) for s in reports["simulations"].keys()]:
+            for r in summaries.keys():
+                print("<all files>\t" + label + "\t" + r, file=sys.stderr)
+                pprint.pprint(summaries[r], compact=True, stream=sys.stderr)
+                print("----------", file=sys.stderr)
+        return
+    bases = [parse_file(f) for f in args.base]
+    sims = [parse_file(f) for f in args.simulation]
+    (base, sim) = (bases[0], sims[0])
+    matrix = len(bases) > 1 or len(sims) > 1
+    if matrix and args.output is not None:
+        parser.error("--output needs a single base and simulation file")
+    if args.trace and args.output is None:
+        parser.error("--trace needs --output")
+    if len(args.choices) == 0 and args.generate == 0 and args.write_choices is None:
+        for base in bases:
+            summary.summarize_options(base)
+        return
+    # only imported once there's something to simulate, to keep the above quick
+    from . import generate
+    from . import simulation
+    sources = []
+    for fname in args.choices:
+        if fname.endswith(".jsonl"):
+            sources.extend(generate.read_choices(fname))
+        else:
+            sources.append(fname)
+    if args.generate > 0:
+        generated = generate.GeneratedChoices(base, args.generate, args.generate_seed, None if args.allow_unbeatable else sim["end-states"], args.extra_findables)
+        sources = generated if len(sources) == 0 else sources + list(generated)
+    if args.write_choices is not None:
+        generate.write_choices(args.write_choices, (simulation.load_choices(source) for source in sources))
     else:
-        with multiprocessing.Pool(max(1, os.cpu_count() - 2)) as pool:
-            simulator = simulation.RandomizerSimulator(args.choices, base, sim, pool=pool)
+        opts = {"engine": args.engine, "chunk-size": args.chunk_size, "seed": args.seed, "keep-raw": args.keep_raw}
+        if args.processes is not None:
+            opts["processes"] = args.processes
+        if args.exact:
+            opts["exact"] = True
+        if args.max_states is not None:
+            opts["max-states"] = args.max_states
+        for (key, value) in [("target-ci", args.target_ci), ("max-count", args.max_count), ("batch-size", args.batch_size), ("memo-size", args.memo_size), ("progress", args.progress), ("partial-summaries", args.partial_summaries)]:
+            if value is not None:
+                opts[key] = value
+        writer = None
+        if args.output is not None:
+            from .output import NpzRunWriter
+            writer = NpzRunWriter(args.output, sim, list(base["unlockables"].keys()), simulation.choices_names(sources), trace=args.trace)
+        if args.instrument:
+            opts["instrument"] = True
+        if args.trace:
+            opts["trace"] = True
+        profile = None
+        if args.profile is not None:
+            import cProfile
+            import tempfile
+            opts["profile-dir"] = tempfile.mkdtemp()
+            profile = cProfile.Profile()
+            profile.enable()
+        cache = None
+        if args.database is not None:
+            from .cache import ResultCache
+            cache = ResultCache(args.database)
+        # no pool at all for jobs too small to be worth starting one
+        opts["processes"] = simulation.pool_size(bases, sims, sources, opts)
+        with (simulation.worker_pool(bases, sims, sources, opts) if opts["processes"] > 0 else contextlib.nullcontext()) as pool:
+            if matrix:
+                simulator = simulation.MatrixSimulator(sources, bases, sims, pool=pool, opts=opts, cache=cache,
+                                                       base_names=[f.name for f in args.base], sim_names=[f.name for f in args.simulation])
+            else:
+                simulator = simulation.RandomizerSimulator(sources, base, sim, pool=pool, opts=opts, output=writer, cache=cache)
             simulator.run()
+        if writer is not None:
+            writer.close()
+        if cache is not None:
+            cache.close()
+        if profile is not None:
+            profile.disable()
+            import glob
+            import pstats
+            import shutil
+            stats = pstats.Stats(profile, stream=sys.stderr)
+            for worker_profile in glob.glob(os.path.join(opts["profile-dir"], "*.prof")):
+                stats.add(worker_profile)
+            shutil.rmtree(opts["profile-dir"])
+            stats.dump_stats(args.profile)
+            stats.sort_stats("cumulative").print_stats(30)
         print(json.dumps(simulator.reports))
-        import pprint
-        for f in simulator.reports["files"].keys():
-            for s in simulator.reports["files"][f]["simulations"].keys():
-                for r in simulator.reports["files"][f]["simulations"][s]["summary"].keys():
-                    print(f + "\t" + s + "\t" + r, file=sys.stderr)
-                    pprint.pprint(simulator.reports["files"][f]["simulations"][s]["summary"][r], compact=True, stream=sys.stderr)
+        if matrix:
+            # a table per sim file, simulation and report: categories down, bases across
+            for (sim_name, comparison) in simulator.reports["comparison"].items():
+                for (label, reports) in [("<all simulations>", comparison["summary"])] + list(comparison["simulations"].items()):
+                    for (r, categories) in reports.items():
+                        print(sim_name + "\t" + label + "\t" + r, file=sys.stderr)
+                        print("\t".join([""] + simulator.base_names), file=sys.stderr)
+                        for (category, percentages) in categories.items():
+                            print("\t".join([category] + ["%.1f%%" % (100 * percentages[b]) for b in simulator.base_names]), file=sys.stderr)
+                        print("----------", file=sys.stderr)
+        else:
+            import pprint
+            for f in simulator.reports["files"].keys():
+                for s in simulator.reports["files"][f]["simulations"].keys():
+                    for r in simulator.reports["files"][f]["simulations"][s]["summary"].keys():
+                        print(f + "\t" + s + "\t" + r, file=sys.stderr)
+                        pprint.pprint(simulator.reports["files"][f]["simulations"][s]["summary"][r], compact=True, stream=sys.stderr)
+                        print("----------", file=sys.stderr)
+            for s in simulator.reports["simulations"].keys():
+                for r in simulator.reports["simulations"][s]["summary"].keys():
+                    print("<all files>\t" + s + "\t" + r, file=sys.stderr)
+                    pprint.pprint(simulator.reports["simulations"][s]["summary"][r], compact=True, stream=sys.stderr)
                     print("----------", file=sys.stderr)
-        for s in simulator.reports["simulations"].keys():
-            for r in simulator.reports["simulations"][s]["summary"].keys():
-                print("<all files>\t" + s + "\t" + r, file=sys.stderr)
-                pprint.pprint(simulator.reports["simulations"][s]["summary"][r], compact=True, stream=sys.stderr)
+            for r in simulator.reports["summary"].keys():
+                print("<all files>\t<all simulations>\t" + r, file=sys.stderr)
+                pprint.pprint(simulator.reports["summary"][r], compact=True, stream=sys.stderr)
                 print("----------", file=sys.stderr)
-        for r in simulator.reports["summary"].keys():
-            print("<all files>\t<all simulations>\t" + r, file=sys.stderr)
-            pprint.pprint(simulator.reports["summary"][r], compact=True, stream=sys.stderr)
-            print("----------", file=sys.stderr)
 
         #print(simulator.reports)
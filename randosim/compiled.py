@@ -0,0 +1,238 @@
+### Compiled form of a base file
+#
+# Every name that can end up in the "got" set (unlockables, things unlocked
+# by them, findables, and anything placed by a choices file) gets an integer
+# id, so sets of them can be stored as int bitsets. Unlockables are interned
+# first, so an unlockable's index in base["unlockables"] is also its item id.
+#
+# Requirements are compiled into a list of clauses (bitmasks); an unlockable
+# is reachable when any clause is fully contained in the got mask. An empty
+# clause list never matches, a [0] clause list always does.
+
+import collections
+
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def _minimize(clauses):
+    kept = []
+    for c in sorted(set(clauses), key=lambda c: bin(c).count("1")):
+        if not any((k & c) == k for k in kept):
+            kept.append(c)
+    return kept
+
+class CompiledBase:
+    def __init__(self, base):
+        self.base = base
+        self.names = []
+        self.ids = {}
+        self.unlockable_names = list(base["unlockables"].keys())
+        for name in self.unlockable_names:
+            self.item_id(name)
+        for name in base["findables"].keys():
+            self.item_id(name)
+
+        self.requirements = []
+        for name in self.unlockable_names:
+            self.requirements.append(self._compile_requirement(base["unlockables"][name]))
+
+        # item id -> mask of items put into unlocks when this item is unlocked/found
+        self.unlock_masks = {}
+        for name, unlockable in base["unlockables"].items():
+            if "unlocks" in unlockable:
+                self.unlock_masks[self.ids[name]] = self.mask(unlockable["unlocks"])
+        self.findable_unlock_masks = {}
+        for name, findable in base["findables"].items():
+            if "unlocks" in findable:
+                self.findable_unlock_masks[self.ids[name]] = self.mask(findable["unlocks"])
+
+        # item id -> unlockable ids whose requirements mention it
+        self.dependents = {}
+        always = []
+        for u in range(len(self.requirements)):
+            clauses = self.requirements[u]
+            mentioned = 0
+            for c in clauses:
+                mentioned |= c
+            if 0 in clauses:
+                always.append(u)
+            for i in bits(mentioned):
+                self.dependents.setdefault(i, []).append(u)
+        self.always_reachable = 0
+        for u in always:
+            self.always_reachable |= 1 << u
+        # ids up to here depend only on the base; names first seen later
+        # (only in a choices file, say) get theirs in whatever order files
+        # happen to be compiled in, which can differ between processes
+        self.base_id_count = len(self.names)
+
+    def item_id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+    def mask(self, names):
+        m = 0
+        for name in names:
+            m |= 1 << self.item_id(name)
+        return m
+
+    def decode(self, mask):
+        return [self.names[i] for i in bits(mask)]
+
+    def _and_clauses(self, req):
+        clauses = [0]
+        for r in req:
+            if isinstance(r, str):
+                sub = [1 << self.item_id(r)]
+            elif isinstance(r, list):
+                sub = self._or_clauses(r)
+            else:
+                sub = []
+            clauses = [c | s for c in clauses for s in sub]
+        return _minimize(clauses)
+
+    def _or_clauses(self, req):
+        clauses = []
+        for r in req:
+            if isinstance(r, str):
+                clauses.append(1 << self.item_id(r))
+            elif isinstance(r, list):
+                clauses.extend(self._and_clauses(r))
+        return _minimize(clauses)
+
+    def _compile_requirement(self, unlockable):
+        if 'requirements' not in unlockable:
+            return [0]
+        req = unlockable["requirements"]
+        if isinstance(req, str):
+            return [1 << self.item_id(req)]
+        elif isinstance(req, list):
+            return self._and_clauses(req)
+        elif isinstance(req, dict):
+            if ("and" in req) and ("or" not in req):
+                return self._and_clauses(req["and"])
+            elif ("or" in req) and ("and" not in req):
+                return self._or_clauses(req["or"])
+            elif ("or" in req) and ("and" in req):
+                # both parts
+                return _minimize([a | o for a in self._and_clauses(req["and"]) for o in self._or_clauses(req["or"])])
+        return []
+
+    def reachable(self, u, got):
+        for c in self.requirements[u]:
+            if (c & got) == c:
+                return True
+        return False
+
+    def compile_choices(self, choices, memo_size=65536):
+        return CompiledChoices(self, choices, memo_size)
+
+class CompiledChoices:
+    def __init__(self, compiled, choices, memo_size=65536):
+        self.compiled_base = compiled
+        self.choices = choices
+        # unlocks mask -> state, for advance(); least recently used out first
+        self.memo = collections.OrderedDict()
+        self.memo_size = memo_size
+        # instrument.Instruments to count closure work in, if instrumenting
+        self.stats = None
+        self.initial_found = [compiled.item_id(choices[k]) for k in compiled.base["initial"].keys()]
+        self._initial = None
+        # item id of a location -> item id of the findable placed there
+        self.location_finds = {}
+        for location, findable in choices.items():
+            if location == "version" or location in compiled.base["initial"]:
+                continue
+            self.location_finds[compiled.item_id(location)] = compiled.item_id(findable)
+        # findables outside the base's ids, ranked by where this file first
+        # places them, so found_order doesn't depend on compile order
+        self.extra_rank = {}
+        for f in self.initial_found + list(self.location_finds.values()):
+            if f >= compiled.base_id_count and f not in self.extra_rank:
+                self.extra_rank[f] = len(self.extra_rank)
+        self.extra_mask = 0
+        for f in self.extra_rank.keys():
+            self.extra_mask |= 1 << f
+
+    def found_order(self, found):
+        # names of the findables in the found mask, in the order the found
+        # hooks see them: the base's in id order, then any others by rank
+        names = self.compiled_base.names
+        if not found & self.extra_mask:
+            return [names[i] for i in bits(found)]
+        extra = sorted(bits(found & self.extra_mask), key=self.extra_rank.__getitem__)
+        return [names[i] for i in bits(found & ~self.extra_mask)] + [names[i] for i in extra]
+
+    def close(self, unlocks, found, unlockables, new_unlocks, new_found):
+        # Propagate newly unlocked/found items until nothing changes, then
+        # re-check only the unlockables whose requirements mention one of the
+        # items gained. Returns the new masks plus the mask of new findables.
+        compiled = self.compiled_base
+        found_before = found
+        unlocks |= new_unlocks
+        found |= new_found
+        gained = new_unlocks | new_found
+        iterations = 0
+        while new_unlocks or new_found:
+            iterations += 1
+            next_unlocks = 0
+            next_found = 0
+            for i in bits(new_unlocks):
+                next_unlocks |= compiled.unlock_masks.get(i, 0)
+                f = self.location_finds.get(i)
+                if f is not None:
+                    next_found |= 1 << f
+            for i in bits(new_found):
+                next_unlocks |= compiled.findable_unlock_masks.get(i, 0)
+            new_unlocks = next_unlocks & ~unlocks
+            new_found = next_found & ~found
+            unlocks |= new_unlocks
+            found |= new_found
+            gained |= new_unlocks | new_found
+        got = unlocks | found
+        checks = 0
+        for i in bits(gained):
+            for u in compiled.dependents.get(i, ()):
+                if not (unlockables >> u) & 1:
+                    checks += 1
+                    if compiled.reachable(u, got):
+                        unlockables |= 1 << u
+        if self.stats is not None:
+            self.stats.count("closures")
+            self.stats.count("fixpoint iterations", iterations)
+            self.stats.count("requirement checks", checks)
+        return (unlocks, found, unlockables, found & ~found_before)
+
+    def advance(self, unlocks, found, unlockables, new_unlocks):
+        # close() for choices made from a state that came from initial() and
+        # advance(): those states depend only on their unlocks, so this is
+        # memoized on the unlocks after, across every run and strategy
+        key = unlocks | new_unlocks
+        state = self.memo.get(key)
+        if self.stats is not None:
+            self.stats.count("memo misses" if state is None else "memo hits")
+        if state is None:
+            state = self.close(unlocks, found, unlockables, new_unlocks, 0)[:3]
+            if self.memo_size:
+                self.memo[key] = state
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        else:
+            self.memo.move_to_end(key)
+        return state + (state[1] & ~found,)
+
+    def initial(self):
+        if self._initial is None:
+            found = 0
+            for f in self.initial_found:
+                found |= 1 << f
+            (unlocks, found, unlockables, _) = self.close(0, 0, self.compiled_base.always_reachable, 0, found)
+            self._initial = (unlocks, found, unlockables)
+        return self._initial
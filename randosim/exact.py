@@ -0,0 +1,99 @@
+from .compiled import bits
+from .simulation import get_report
+
+### Exact engine
+#
+# A weighted-random run is a Markov chain over the set of unlockables chosen
+# so far: that set fixes everything unlocked and found, and each step picks
+# one more with the strategy's first-choices/weights. Report state is the
+# categories matched so far, in order. Every choice adds one unlockable, so
+# states are expanded a layer (choice count) at a time, merging states with
+# the same (chosen, matched) key and adding up their probabilities, until
+# every path reaches an end state. Returns None if there are more than
+# max_states distinct states, so the caller can sample instead.
+
+class ExactSimulation:
+    def __init__(self, compiled, sim, strategy, max_states=100000):
+        self.compiled = compiled
+        self.sim = sim
+        self.strategy = strategy
+        self.max_states = max_states
+        self.names = compiled.compiled_base.names
+        self.end_mask = compiled.compiled_base.mask(sim["end-states"])
+        self.labels = [r["label"] for r in sim["reports"]]
+        self.reporters = [get_report(r) for r in sim["reports"]]
+        self.states = 0
+
+    def _restore(self, report_states, matched):
+        # put the reporters back in a state's place; reports is what the
+        # hooks append newly matched categories to
+        reports = {}
+        for (r, report) in enumerate(self.reporters):
+            reports[self.labels[r]] = list(matched[r])
+            if report is not None:
+                (report.held, report.latched, report.dead, report.checked) = report_states[r]
+        return reports
+
+    def _save(self, reports):
+        report_states = tuple(None if report is None else (report.held, report.latched, report.dead, report.checked) for report in self.reporters)
+        return (report_states, tuple(tuple(reports[label]) for label in self.labels))
+
+    def _found_hooks(self, reports, new_found):
+        # in the same order SimulationSingle calls them
+        for findable in self.compiled.found_order(new_found):
+            for report in self.reporters:
+                if report is not None:
+                    reports = report.found(reports, findable)
+        return reports
+
+    def _choice_probabilities(self, available):
+        for choice in self.strategy.first_choice_ids:
+            if (available >> choice) & 1:
+                return [(choice, 1.0)]
+        ids = list(bits(available))
+        if not ids:
+            raise IndexError('Cannot choose from an empty sequence')
+        weights = [self.strategy.weight_of.get(i, 1) for i in ids]
+        total = sum(weights)
+        if total == 0:
+            # weighted_choice bisects into all-zero cumulative weights and
+            # lands on the last option
+            return [(ids[-1], 1.0)]
+        return [(i, w / total) for (i, w) in zip(ids, weights) if w]
+
+    def run(self):
+        # returns {matched categories per report: probability}
+        (unlocks, found, unlockables) = self.compiled.initial()
+        for report in self.reporters:
+            if report is not None:
+                report.reset()
+        reports = self._found_hooks({label: [] for label in self.labels}, found)
+        (report_states, matched) = self._save(reports)
+        layer = {(0, matched): [1.0, unlocks, found, unlockables, report_states]}
+        self.states = 1
+        outcomes = {}
+        while layer:
+            next_layer = {}
+            for ((chosen, matched), (p, unlocks, found, unlockables, report_states)) in layer.items():
+                if unlocks & self.end_mask:
+                    outcomes[matched] = outcomes.get(matched, 0.0) + p
+                    continue
+                for (choice, q) in self._choice_probabilities(unlockables & ~unlocks):
+                    reports = self._restore(report_states, matched)
+                    for report in self.reporters:
+                        if report is not None:
+                            reports = report.made_choice(reports, self.names[choice])
+                    (u1, f, u2, new_f) = self.compiled.advance(unlocks, found, unlockables, 1 << choice)
+                    reports = self._found_hooks(reports, new_f)
+                    (next_states, next_matched) = self._save(reports)
+                    key = (chosen | (1 << choice), next_matched)
+                    state = next_layer.get(key)
+                    if state is None:
+                        next_layer[key] = [p * q, u1, f, u2, next_states]
+                        self.states += 1
+                        if self.states > self.max_states:
+                            return None
+                    else:
+                        state[0] += p * q
+            layer = next_layer
+        return outcomes
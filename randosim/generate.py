@@ -0,0 +1,97 @@
+import hashlib
+import json
+import random
+
+from .compiled import CompiledBase
+
+### Generated choices
+#
+# Random choices mappings built straight from a base file: the findables
+# (plus any extra names, e.g. characters, that requirements mention but the
+# base never defines) go one each into the initial locations, then into
+# random unlockable locations. Seed i of a GeneratedChoices is a pure
+# function of (seed, i), so workers can rebuild any of them without the
+# mappings ever being written out or shipped around.
+
+def implicit_findables(base):
+    # names requirements mention that nothing in the base defines, so they
+    # can only come from a choices file
+    compiled = CompiledBase(base)
+    defined = set(base["unlockables"].keys()) | set(base["findables"].keys())
+    for thing in list(base["unlockables"].values()) + list(base["findables"].values()):
+        defined |= set(thing.get("unlocks", []))
+    mentioned = set()
+    for clauses in compiled.requirements:
+        for clause in clauses:
+            mentioned |= set(compiled.decode(clause))
+    return sorted(mentioned - defined)
+
+def beatable(compiled_choices, end_mask):
+    # doing everything available until nothing new is: does it reach an end state?
+    (unlocks, found, unlockables) = compiled_choices.initial()
+    while not (unlocks & end_mask):
+        available = unlockables & ~unlocks
+        if not available:
+            return False
+        (unlocks, found, unlockables, _) = compiled_choices.close(unlocks, found, unlockables, available, 0)
+    return True
+
+class GeneratedChoices:
+    def __init__(self, base, count, seed=0, end_states=None, extra=None, max_attempts=1000):
+        self.base = base
+        self.count = count
+        self.seed = seed
+        # only beatable seeds, if given end states
+        self.end_states = end_states
+        self.items = list(base["findables"].keys()) + (implicit_findables(base) if extra is None else list(extra))
+        self.initial_locations = list(base["initial"].keys())
+        self.locations = list(base["unlockables"].keys())
+        self.max_attempts = max_attempts
+        if len(self.items) < len(self.initial_locations):
+            raise ValueError("Need at least %d findables to fill the initial locations, have %d" % (len(self.initial_locations), len(self.items)))
+        if len(self.items) > len(self.initial_locations) + len(self.locations):
+            raise ValueError("More findables (%d) than locations (%d)" % (len(self.items), len(self.initial_locations) + len(self.locations)))
+        self._compiled_base = None
+
+    def __len__(self):
+        return self.count
+
+    def name(self, index):
+        return "generated-%d-%d" % (self.seed, index)
+
+    def names(self):
+        return [self.name(i) for i in range(self.count)]
+
+    def choices(self, index):
+        key = json.dumps(["generate", self.seed, index]).encode('utf-8')
+        rng = random.Random(int.from_bytes(hashlib.sha256(key).digest()[:8], 'big'))
+        if self.end_states is not None and self._compiled_base is None:
+            self._compiled_base = CompiledBase(self.base)
+            self._end_mask = self._compiled_base.mask(self.end_states)
+        for attempt in range(self.max_attempts):
+            items = list(self.items)
+            rng.shuffle(items)
+            choices = {"version": 1}
+            placed = len(self.initial_locations)
+            for (location, item) in zip(self.initial_locations, items):
+                choices[location] = item
+            for (location, item) in zip(rng.sample(self.locations, len(items) - placed), items[placed:]):
+                choices[location] = item
+            if self.end_states is None or beatable(self._compiled_base.compile_choices(choices), self._end_mask):
+                return choices
+        raise ValueError("No beatable placement for %s in %d attempts" % (self.name(index), self.max_attempts))
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        return (self.name(index), self.choices(index))
+
+def write_choices(path, sources):
+    # many choices mappings in one file, one JSON object per line
+    with open(path, 'w') as f:
+        for (name, choices) in sources:
+            f.write(json.dumps({"name": name, "choices": choices}) + "\n")
+
+def read_choices(path):
+    with open(path, 'r') as f:
+        return [(entry["name"], entry["choices"]) for entry in (json.loads(line) for line in f if line.strip())]
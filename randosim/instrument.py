@@ -0,0 +1,52 @@
+import contextlib
+import time
+
+### Instrumentation
+#
+# Counters and timers (in seconds) for the phases of a simulation, kept per
+# simulation when the "instrument" opt is set and merged up per file and
+# overall, like the report accumulators. Workers send theirs back with each
+# task's results.
+
+class Instruments:
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def merge(self, other):
+        for (name, n) in other.counters.items():
+            self.count(name, n)
+        for (name, seconds) in other.timers.items():
+            self.add_time(name, seconds)
+        return self
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "timers": dict(self.timers)}
+
+    @classmethod
+    def from_dict(cls, data):
+        instruments = cls()
+        instruments.counters = dict(data["counters"])
+        instruments.timers = dict(data["timers"])
+        return instruments
+
+def merge_instruments(sources):
+    instruments = Instruments()
+    for source in sources:
+        if source is not None:
+            instruments.merge(source)
+    return instruments
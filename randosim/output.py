@@ -0,0 +1,150 @@
+import json
+import zipfile
+
+import numpy as np
+
+### Columnar run output
+#
+# One row per run, written to an .npz (zip of .npy arrays) in chunks as
+# results come in, so a sweep never has to hold its per-run data. Each chunk
+# is a set of arrays named chunkNNNNNN/<column>.npy:
+#
+#  * file_id, simulation_id, run: which choices file, simulation and run index
+#  * seed: the run's seed
+#  * choice_count
+#  * choice_offsets, choices: the choice sequences, as unlockable ids,
+#    concatenated (row i's choices are choices[choice_offsets[i]:choice_offsets[i + 1]])
+#  * report_<n>: for the n-th report, the categories it matched as a
+#    (rows, ceil(categories / 8)) uint8 array of bits: category k is bit
+#    k % 8 (least significant first) of byte k // 8, as np.unpackbits(...,
+#    axis=1, bitorder='little') reads it back
+#
+# With trace=True (runs recorded with the "trace" opt), also each run's steps:
+#
+#  * available: per choice, how many unlockables it was picked from (indexed
+#    like choices)
+#  * found_counts: how many findables were found before the first choice,
+#    then after each one (row i's are found_counts[choice_offsets[i] + i:choice_offsets[i + 1] + i + 1])
+#  * found_offsets, found: the findables found, as findable ids, in order,
+#    concatenated like choices
+#
+# metadata.npy holds a JSON string with the names behind all those ids.
+
+class NpzRunWriter:
+    def __init__(self, path, sim, unlockable_names, file_names, chunk_rows=65536, trace=False):
+        self.zip = zipfile.ZipFile(path, 'w', allowZip64=True)
+        self.chunk_rows = chunk_rows
+        self.chunks = 0
+        self.metadata = {
+            "version": 2,
+            "files": list(file_names),
+            "simulations": [s.get("label", str(i)) for (i, s) in enumerate(sim["simulations"])],
+            "unlockables": list(unlockable_names),
+            "reports": [{"label": r["label"], "categories": list(r.get("categories", {}).keys())} for r in sim["reports"]],
+            "report_bits": "uint8 (rows, ceil(categories / 8)), category k in bit k % 8 of byte k // 8",
+        }
+        self.trace = trace
+        if trace:
+            # named as they turn up
+            self.metadata["trace"] = True
+            self.metadata["findables"] = []
+            self.findable_ids = {}
+        self.choice_ids = {name: i for (i, name) in enumerate(unlockable_names)}
+        self.category_bits = [{c: k for (k, c) in enumerate(r["categories"])} for r in self.metadata["reports"]]
+        self._reset()
+
+    def _reset(self):
+        self.rows = {"file_id": [], "simulation_id": [], "run": [], "seed": [], "choice_count": []}
+        self.offsets = [0]
+        self.choices = []
+        self.report_masks = [[] for r in self.metadata["reports"]]
+        self.available = []
+        self.found_counts = []
+        self.found_offsets = [0]
+        self.found = []
+
+    def findable_id(self, name):
+        i = self.findable_ids.get(name)
+        if i is None:
+            i = len(self.metadata["findables"])
+            self.findable_ids[name] = i
+            self.metadata["findables"].append(name)
+        return i
+
+    def add(self, file_id, simulation_id, run, reports):
+        self.rows["file_id"].append(file_id)
+        self.rows["simulation_id"].append(simulation_id)
+        self.rows["run"].append(run)
+        self.rows["seed"].append(reports.get("seed", 0))
+        self.rows["choice_count"].append(reports["choice_count"])
+        self.choices.extend(self.choice_ids[c] for c in reports["choices"])
+        self.offsets.append(len(self.choices))
+        for (n, r) in enumerate(self.metadata["reports"]):
+            mask = 0
+            for c in reports.get(r["label"], []):
+                mask |= 1 << self.category_bits[n][c]
+            self.report_masks[n].append(mask)
+        if self.trace:
+            trace = reports["trace"]
+            self.available.extend(trace["available"])
+            self.found_counts.extend(trace["found_counts"])
+            self.found.extend(self.findable_id(f) for f in trace["found"])
+            self.found_offsets.append(len(self.found))
+        if len(self.offsets) - 1 >= self.chunk_rows:
+            self.flush()
+
+    def _write(self, name, array):
+        with self.zip.open(name + ".npy", 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array))
+
+    def flush(self):
+        if len(self.offsets) == 1:
+            return
+        prefix = "chunk%06d/" % self.chunks
+        self._write(prefix + "file_id", np.array(self.rows["file_id"], dtype=np.int32))
+        self._write(prefix + "simulation_id", np.array(self.rows["simulation_id"], dtype=np.int32))
+        self._write(prefix + "run", np.array(self.rows["run"], dtype=np.int64))
+        self._write(prefix + "seed", np.array(self.rows["seed"], dtype=np.uint64))
+        self._write(prefix + "choice_count", np.array(self.rows["choice_count"], dtype=np.int32))
+        self._write(prefix + "choice_offsets", np.array(self.offsets, dtype=np.int64))
+        self._write(prefix + "choices", np.array(self.choices, dtype=np.int16))
+        for n in range(len(self.report_masks)):
+            width = (len(self.metadata["reports"][n]["categories"]) + 7) // 8
+            masks = b"".join(mask.to_bytes(width, 'little') for mask in self.report_masks[n])
+            self._write(prefix + "report_%d" % n, np.frombuffer(masks, dtype=np.uint8).reshape(len(self.report_masks[n]), width))
+        if self.trace:
+            self._write(prefix + "available", np.array(self.available, dtype=np.int16))
+            self._write(prefix + "found_counts", np.array(self.found_counts, dtype=np.int16))
+            self._write(prefix + "found_offsets", np.array(self.found_offsets, dtype=np.int64))
+            self._write(prefix + "found", np.array(self.found, dtype=np.int16))
+        self.chunks += 1
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.metadata["chunks"] = self.chunks
+        self._write("metadata", np.array(json.dumps(self.metadata)))
+        self.zip.close()
+
+# offsets column -> the column it indexes
+_offsets = {"choice_offsets": "choices", "found_offsets": "found"}
+
+def load_runs(path):
+    # read a file written by NpzRunWriter back as (metadata, columns), with
+    # each column's chunks concatenated (offsets rebased to match)
+    data = np.load(path)
+    metadata = json.loads(str(data["metadata"]))
+    columns = {}
+    bases = {name: 0 for name in _offsets.keys()}
+    for i in range(metadata["chunks"]):
+        prefix = "chunk%06d/" % i
+        for name in [n[len(prefix):] for n in data.files if n.startswith(prefix)]:
+            array = data[prefix + name]
+            if name in _offsets:
+                # every chunk's offsets start at 0; drop that after the first chunk
+                array = array + bases[name]
+                if i > 0:
+                    array = array[1:]
+                bases[name] += len(data[prefix + _offsets[name]])
+            columns.setdefault(name, []).append(array)
+    return (metadata, {name: np.concatenate(arrays) for (name, arrays) in columns.items()})
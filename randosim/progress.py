@@ -0,0 +1,75 @@
+import sys
+import time
+
+### Progress
+#
+# Runs done, runs/sec and ETA, overall and for each choices file under way,
+# printed to stderr at most every `interval` seconds as results come in.
+# With a summary_interval, also a partial summary (individual percentages
+# of each report so far) from the summarize callback, which returns
+# {report label: accumulator}. A label goes in front of every line, to tell
+# apart several running at once.
+
+def _duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+class Progress:
+    def __init__(self, file_names, file_totals, interval=10, summary_interval=None, summarize=None, stream=sys.stderr, label=None):
+        self.file_names = file_names
+        # runs expected per file; lowered as simulations finish with fewer
+        self.file_totals = list(file_totals)
+        self.file_done = [0] * len(self.file_totals)
+        self.total = sum(self.file_totals)
+        self.done = 0
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self.summarize = summarize
+        self.stream = stream
+        self.prefix = "" if label is None else label + ": "
+        self.start = time.monotonic()
+        self.last = self.start
+        self.last_summary = self.start
+
+    def add(self, file_index, runs):
+        self.done += runs
+        self.file_done[file_index] += runs
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+        if self.summary_interval is not None and now - self.last_summary >= self.summary_interval:
+            self.last_summary = now
+            self.partial_summary()
+
+    def finish_unit(self, file_index, expected, done):
+        # a simulation took fewer runs than it might have (target-ci, cached)
+        self.file_totals[file_index] -= expected - done
+        self.total -= expected - done
+
+    def _eta(self, remaining, rate):
+        return _duration(remaining / rate) if rate > 0 else "?"
+
+    def report(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        rate = self.done / max(now - self.start, 1e-9)
+        print("PROGRESS: %s%d/%d runs, %.0f runs/s, ETA %s" % (self.prefix, self.done, self.total, rate, self._eta(self.total - self.done, rate)), file=self.stream)
+        for i in range(len(self.file_totals)):
+            if 0 < self.file_done[i] < self.file_totals[i]:
+                print("PROGRESS:   %s%s: %d/%d runs, ETA %s" % (self.prefix, self.file_names[i], self.file_done[i], self.file_totals[i], self._eta(self.file_totals[i] - self.file_done[i], rate)), file=self.stream)
+        self.stream.flush()
+
+    def partial_summary(self):
+        print("PARTIAL: %safter %d runs" % (self.prefix, self.done), file=self.stream)
+        for (label, acc) in self.summarize().items():
+            if acc.count == 0:
+                continue
+            percentages = acc.finish()["individual_percentages"]
+            shown = ", ".join("%s %.1f%%" % (c, 100 * p) for (c, p) in sorted(percentages.items(), key=lambda kv: -kv[1]))
+            print("PARTIAL:   %s%s: %s" % (self.prefix, label, shown), file=self.stream)
+        self.stream.flush()
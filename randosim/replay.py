@@ -0,0 +1,69 @@
+from .output import load_runs
+from .simulation import get_report, merge_accumulators
+
+### Replaying traces
+#
+# Runs written by analyze --output --trace hold every step's choice and the
+# findables gained after it, which is all a qualitative report's hooks see.
+# So a sim file's reports can be worked out over recorded runs by calling
+# the hooks in the same order SimulationSingle does (findables found at the
+# start, then each choice followed by what it found), without simulating.
+# Results are summarized per (choices file, simulation), per file, per
+# simulation and overall, as analyze does.
+
+def _replay_run(reporters, reports, choices, found_counts, found):
+    for report in reporters:
+        report.reset()
+    position = 0
+    for step in range(len(found_counts)):
+        if step > 0:
+            for report in reporters:
+                reports = report.made_choice(reports, choices[step - 1])
+        for findable in found[position:position + found_counts[step]]:
+            for report in reporters:
+                reports = report.found(reports, findable)
+        position += found_counts[step]
+    return reports
+
+def _finish(accumulators):
+    return {label: acc.finish() for (label, acc) in accumulators.items()}
+
+def replay(paths, sim):
+    reporters = [(r["label"], get_report(r)) for r in sim["reports"]]
+    reporters = [(label, report) for (label, report) in reporters if report is not None]
+    # (choices file, simulation label) -> {report label: accumulator}
+    units = {}
+    for path in paths:
+        (metadata, columns) = load_runs(path)
+        if not metadata.get("trace"):
+            raise ValueError("%s has no traces; write it with analyze --output --trace" % path)
+        unlockables = metadata["unlockables"]
+        findables = metadata["findables"]
+        choices = [unlockables[c] for c in columns["choices"].tolist()]
+        found = [findables[f] for f in columns["found"].tolist()]
+        choice_offsets = columns["choice_offsets"].tolist()
+        found_offsets = columns["found_offsets"].tolist()
+        found_counts = columns["found_counts"].tolist()
+        for (i, (file_id, simulation_id)) in enumerate(zip(columns["file_id"].tolist(), columns["simulation_id"].tolist())):
+            key = (metadata["files"][file_id], metadata["simulations"][simulation_id])
+            accumulators = units.get(key)
+            if accumulators is None:
+                accumulators = {label: report.accumulator() for (label, report) in reporters}
+                units[key] = accumulators
+            (start, stop) = (choice_offsets[i], choice_offsets[i + 1])
+            reports = _replay_run([report for (_, report) in reporters], {label: [] for (label, _) in reporters},
+                                  choices[start:stop], found_counts[start + i:stop + i + 1], found[found_offsets[i]:found_offsets[i + 1]])
+            for (label, acc) in accumulators.items():
+                acc.update(reports[label])
+
+    results = {"files": {}, "simulations": {}, "summary": {}}
+    files = sorted(set(f for (f, _) in units.keys()))
+    labels = sorted(set(s for (_, s) in units.keys()))
+    for f in files:
+        file_units = {s: acc for ((uf, s), acc) in units.items() if uf == f}
+        results["files"][f] = {"simulations": {s: {"summary": _finish(acc)} for (s, acc) in file_units.items()},
+                               "summary": _finish(merge_accumulators(sim, file_units.values()))}
+    for s in labels:
+        results["simulations"][s] = {"summary": _finish(merge_accumulators(sim, [acc for ((_, us), acc) in units.items() if us == s]))}
+    results["summary"] = _finish(merge_accumulators(sim, units.values()))
+    return results
@@ -1,118 +1,177 @@
+import array
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import math
+import os
 import random
-import copy
 import sys
+import time
 
 from . import summary
+from .compiled import CompiledBase, bits
+from .instrument import Instruments, merge_instruments
 from .parse_file import parse_file
 
 ### Making choices
 
 class WeightedRandomSimulation:
-    def __init__(self, simulation):
+    def __init__(self, simulation, compiled_base=None):
         self.first_choices = simulation.get('first-choices', [])
         self.weights = simulation.get('weights', {})
-    def choose(self, available):
-        for choice in self.first_choices:
-            if choice in available:
+        if compiled_base is not None:
+            # id-based versions of the above, for choose_id
+            self.first_choice_ids = [compiled_base.item_id(c) for c in self.first_choices]
+            self.weight_of = {compiled_base.item_id(c): w for (c, w) in self.weights.items()}
+    def choose_id(self, available, rng=random):
+        # available is a bitset of unlockable ids
+        for choice in self.first_choice_ids:
+            if (available >> choice) & 1:
                 return choice
-        if len(self.weights.keys()) == 0:
-            return random.choice(available)
-        else:
-            weights = [self.weights.get(w, 1) for w in available]
-            return random.choices(available, weights=weights)[0]
+        ids = list(bits(available))
+        return weighted_choice(ids, [self.weight_of.get(i, 1) for i in ids], rng)
+
+def weighted_choice(population, weights, rng=random):
+    # the same draw random.choices makes, done by hand so the batch engine
+    # can make the identical one: one rng.random() per call, bisected into
+    # the cumulative weights
+    if len(population) == 0:
+        raise IndexError('Cannot choose from an empty sequence')
+    cum_weights = list(itertools.accumulate(weights))
+    return population[bisect.bisect(cum_weights, rng.random() * cum_weights[-1], 0, len(population) - 1)]
 
-def get_sim(simulation):
+def run_seed(seed, file_name, label, index):
+    # each run gets its own stream, derived from the master seed and where
+    # the run sits, so it doesn't matter which process runs it or in what order
+    key = json.dumps([seed, file_name, label, index]).encode('utf-8')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'big')
+
+def get_sim(simulation, compiled_base=None):
     if simulation.get('type', 'weighted-random') in ['weighted-random', 'random', 'fixed-list']:
-        return WeightedRandomSimulation(simulation)
+        return WeightedRandomSimulation(simulation, compiled_base)
     else:
-        return WeightedRandomSimulation(simulation)
-
-
-### Checking unlockable requirements
-
-def _strmet(reqstr, got):
-    return reqstr in got
-
-def meets_and_req(req, got):
-    met_reqs = []
-    for r in req:
-        if isinstance(r, str) and _strmet(r, got):
-            met_reqs.append(r)
-        elif isinstance(r, list) and meets_or_req(r, got):
-            met_reqs.append(r)
-    return (len(req) == len(met_reqs))
-
-def meets_or_req(req, got):
-    met_req = False
-    for r in req:
-        if isinstance(r, str) and _strmet(r, got):
-            met_req = True
-            break
-        elif isinstance(r, list):
-            f = meets_and_req(r, got)
-            if f:
-                met_req = f
-                break
-    return met_req
+        return WeightedRandomSimulation(simulation, compiled_base)
 
-class QualitativeReport:
-    def __init__(self, label, categories):
-        self.supported_hooks = ['made-choice', 'found']
-        self.label = label
-        self.categories = categories
-        self.choices = []
-        self.founds = []
 
-    def condition_matches(self, condition):
+class QualitativeCategories:
+    # A qualitative report's categories, compiled once. Each distinct
+    # condition gets a bit in a "held" mask, each category becomes and /
+    # and_not / or / or_not masks over those bits, and each condition knows
+    # which categories it can affect.
+    def __init__(self, categories):
+        self.names = list(categories.keys())
+        self.choice_bits = {}
+        self.findable_bits = {}
+        self.conditions = []
+        # bits for conditions of unknown types, which never hold
+        self.never = 0
+        self.and_masks = []
+        self.and_not_masks = []
+        self.or_masks = []
+        self.or_not_masks = []
+        self.has_or = []
+        self.affects = []
+        for name in self.names:
+            category = categories[name]
+            if "type" in category:
+                category = {"and": [category]}
+            self.and_masks.append(self._mask(category.get("and", [])))
+            self.and_not_masks.append(self._mask(category.get("and_not", [])))
+            self.or_masks.append(self._mask(category.get("or", [])))
+            self.or_not_masks.append(self._mask(category.get("or_not", [])))
+            self.has_or.append("or" in category or "or_not" in category)
+        self.all_categories = (1 << len(self.names)) - 1
+        for k in range(len(self.names)):
+            for bit in bits(self.and_masks[k] | self.and_not_masks[k] | self.or_masks[k] | self.or_not_masks[k]):
+                self.affects[bit] |= 1 << k
+
+    def _bit(self, condition):
         if condition["type"] == "made-choice":
-            return (condition["choice"] in self.choices)
+            table = self.choice_bits
+            key = condition["choice"]
         elif condition["type"] == "got-findable":
-            return (condition["findable"] in self.founds)
+            table = self.findable_bits
+            key = condition["findable"]
         else:
             print("Unknown condition type", condition["type"])
+            table = {}
+            key = None
+        bit = table.get(key)
+        if bit is None:
+            bit = len(self.conditions)
+            self.conditions.append(condition)
+            self.affects.append(0)
+            if key is None:
+                self.never |= 1 << bit
+            else:
+                table[key] = bit
+        return bit
+
+    def _mask(self, conditions):
+        mask = 0
+        for c in conditions:
+            mask |= 1 << self._bit(c)
+        return mask
+
+    def matches(self, k, held):
+        if (held & self.and_masks[k]) != self.and_masks[k]:
             return False
+        if held & self.and_not_masks[k]:
+            return False
+        if self.has_or[k]:
+            return bool((held & self.or_masks[k]) or (~held & self.or_not_masks[k]))
+        return True
 
-    def category_matches(self, category):
-        if "type" in category:
-            category = {"and": [category]}
-        if "and" in category:
-            # loop over all of them, return false if any returns false
-            for c in category["and"]:
-                if not self.condition_matches(c):
-                    return False
-        if "and_not" in category:
-            # loop over all of them, return false if any returns true
-            for c in category["and"]:
-                if self.condition_matches(c):
-                    return False
-
-        if "or" in category or "or_not" in category:
-            # return true on first match
-            for c in category.get("or", []):
-                if self.condition_matches(c):
-                    return True
-            for c in category.get("or_not", []):
-                if not self.condition_matches(c):
-                    return True
-            return False # if we got here, we checked all the ors and got none
-        else:
-            # there is no 'or', so if we got here, all the ands matched
+    def dead(self, k, held):
+        # held only ever grows, so these can't start matching later
+        if (self.and_masks[k] & self.never) or (held & self.and_not_masks[k]):
             return True
+        return self.has_or[k] and (self.or_masks[k] & ~self.never) == 0 and (self.or_not_masks[k] & ~held) == 0
 
-    def check_categories(self, reports):
-        for cat in self.categories.keys():
-            category = self.categories[cat]
-            if self.category_matches(category) and cat not in reports[self.label]:
-                reports[self.label].append(cat)
+class QualitativeReport:
+    def __init__(self, label, categories, compiled=None):
+        self.supported_hooks = ['made-choice', 'found']
+        self.label = label
+        self.categories = categories
+        if compiled is None:
+            compiled = QualitativeCategories(categories)
+        self.compiled = compiled
+        self.reset()
+
+    def reset(self):
+        self.held = 0
+        self.latched = 0
+        self.dead = 0
+        self.checked = False
+
+    def check_categories(self, reports, candidates=None):
+        # the first check looks at every category; after that only the ones
+        # a newly held condition affects, skipping matched and dead ones
+        compiled = self.compiled
+        if not self.checked or candidates is None:
+            candidates = compiled.all_categories
+            self.checked = True
+        for k in bits(candidates & ~(self.latched | self.dead)):
+            if compiled.matches(k, self.held):
+                self.latched |= 1 << k
+                reports[self.label].append(compiled.names[k])
+            elif compiled.dead(k, self.held):
+                self.dead |= 1 << k
         return reports
 
+    def _hold(self, reports, bit):
+        if bit is None or (self.held >> bit) & 1:
+            return self.check_categories(reports, 0)
+        self.held |= 1 << bit
+        return self.check_categories(reports, self.compiled.affects[bit])
+
     def made_choice(self, reports, choice_made):
-        self.choices.append(choice_made)
-        return self.check_categories(reports)
+        return self._hold(reports, self.compiled.choice_bits.get(choice_made))
 
     def found(self, reports, findable_found):
-        self.founds.append(findable_found)
-        return self.check_categories(reports)
+        return self._hold(reports, self.compiled.findable_bits.get(findable_found))
 
     def combine_simulations(self, reports, label):
         data = []
@@ -123,37 +182,83 @@ class QualitativeReport:
     def combine_files(self, reports, report_label, simulation_label):
         data = []
         for f in reports["files"].keys():
-            data.extend(reports["files"][f]["raw"][report_label])
+            data.extend(reports["files"][f]["simulations"][simulation_label]["raw"][report_label])
         return data
 
+    def accumulator(self):
+        return QualitativeAccumulator()
+
     def summarize_raw_data(self, raw_data):
+        acc = self.accumulator()
+        for run in raw_data:
+            acc.update(run)
+        return acc.finish()
+
+class QualitativeAccumulator:
+    # Running counts for a QualitativeReport summary: update with one run's
+    # categories at a time, merge with accumulators from other runs/files,
+    # and finish into the same dict summarize_raw_data returns.
+    def __init__(self):
+        self.count = 0
+        self.individual_counts = {}
+        self.joint_counts = {}
+        self.joint_ordered_counts = {}
+
+    def update(self, run, weight=1):
+        self.count += weight
+        joint_key = "::".join(sorted(run))
+        self.joint_counts[joint_key] = self.joint_counts.get(joint_key, 0) + weight
+        ordered_key = "::".join(run)
+        self.joint_ordered_counts[ordered_key] = self.joint_ordered_counts.get(ordered_key, 0) + weight
+        for category in run:
+            self.individual_counts[category] = self.individual_counts.get(category, 0) + weight
+
+    def merge(self, other):
+        self.count += other.count
+        for (mine, theirs) in [(self.individual_counts, other.individual_counts), (self.joint_counts, other.joint_counts), (self.joint_ordered_counts, other.joint_ordered_counts)]:
+            for (key, value) in theirs.items():
+                mine[key] = mine.get(key, 0) + value
+        return self
+
+    def half_width(self, category, z=1.96):
+        # half the width of the Wilson score interval for category's percentage
+        n = self.count
+        if n == 0:
+            return 1.0
+        p = self.individual_counts.get(category, 0) / n
+        return z / (1 + z * z / n) * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+
+    def to_dict(self):
+        return {"count": self.count, "individual_counts": self.individual_counts, "joint_counts": self.joint_counts, "joint_ordered_counts": self.joint_ordered_counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.count = data["count"]
+        acc.individual_counts = dict(data["individual_counts"])
+        acc.joint_counts = dict(data["joint_counts"])
+        acc.joint_ordered_counts = dict(data["joint_ordered_counts"])
+        return acc
+
+    def finish(self):
         summary = {}
-        summary["all_seen"] = []
+        count = self.count
+        summary["all_seen"] = sorted(self.individual_counts.keys())
         summary["individual_percentages"] = {}
-        summary["individual_counts"] = {}
+        summary["individual_counts"] = dict(self.individual_counts)
         summary["joint_percentages"] = {}
-        summary["joint_counts"] = {}
+        summary["joint_counts"] = dict(self.joint_counts)
         summary["joint_ordered_percentages"] = {}
-        summary["joint_ordered_counts"] = {}
-        count = len(raw_data)
-        for run in raw_data:
-            summary["all_seen"].extend(run)
-            joint_key = "::".join(sorted(run))
-            summary["joint_counts"][joint_key] = summary["joint_counts"].get(joint_key, 0) + 1
-            ordered_key = "::".join(run)
-            summary["joint_ordered_counts"][ordered_key] = summary["joint_ordered_counts"].get(ordered_key, 0) + 1
-            for category in run:
-                summary["individual_counts"][category] = summary["individual_counts"].get(category, 0) + 1
-        summary["all_seen"] = list(set(summary["all_seen"]))
+        summary["joint_ordered_counts"] = dict(self.joint_ordered_counts)
         for category in summary["individual_counts"].keys():
             summary["individual_percentages"][category] = summary["individual_counts"][category] / count
-        summary["individual_percentages_sum"] = sum(summary["individual_percentages"].values())
+        summary["individual_percentages_sum"] = math.fsum(summary["individual_percentages"].values())
         for category in summary["joint_counts"].keys():
             summary["joint_percentages"][category] = summary["joint_counts"][category] / count
-        summary["joint_percentages_sum"] = sum(summary["joint_percentages"].values())
+        summary["joint_percentages_sum"] = math.fsum(summary["joint_percentages"].values())
         for category in summary["joint_ordered_counts"].keys():
             summary["joint_ordered_percentages"][category] = summary["joint_ordered_counts"][category] / count
-        summary["joint_ordered_percentages_sum"] = sum(summary["joint_ordered_percentages"].values())
+        summary["joint_ordered_percentages_sum"] = math.fsum(summary["joint_ordered_percentages"].values())
         return summary
 
 
@@ -162,19 +267,58 @@ def get_report(report):
         return QualitativeReport(report["label"], report["categories"])
     return None
 
+class RunState:
+    __slots__ = ('unlocks', 'found', 'unlockables', 'history')
+
+    def __init__(self):
+        self.history = array.array('i')
+        self.reset(0, 0, 0)
+
+    def reset(self, unlocks, found, unlockables):
+        self.unlocks = unlocks
+        self.found = found
+        self.unlockables = unlockables
+        del self.history[:]
+
+    def available(self):
+        return self.unlockables & ~self.unlocks
+
+    def choose(self, choice):
+        self.history.append(choice)
+
+# stands in for time.perf_counter in SimulationSingle.run when not instrumenting
+def _no_clock():
+    return 0.0
+
 class SimulationSingle:
-    def __init__(self, base, sim, simulation, choices, opts={}):
+    def __init__(self, base, sim, simulation, choices, opts={}, compiled=None, strategy=None, state=None, seed=None, reporters=None, instruments=None):
         self.reports = {"choices": [], "choice_count": 0}
         self.base = base
         self.sim = sim
         self.simulation = simulation
         self.choices = choices
         self.opts = opts
-
-        self._initf = None
-        self.found = []
-        self.unlocks = []
-        self.unlockables = []
+        if compiled is None:
+            compiled = CompiledBase(base).compile_choices(choices)
+        self.compiled = compiled
+        if strategy is None:
+            strategy = get_sim(simulation, compiled.compiled_base)
+        self.strategy = strategy
+        if state is None:
+            state = RunState()
+        self.state = state
+        if seed is None:
+            self.rng = random
+        else:
+            self.rng = random.Random(seed)
+            self.reports["seed"] = seed
+        self._end_mask = compiled.compiled_base.mask(sim["end-states"])
+        # report objects to reuse (after a reset) instead of making new ones
+        self.reporters = reporters
+        # instrument.Instruments to time and count phases in, if instrumenting
+        self.instruments = instruments
+        # with the "trace" opt, each step's available count and findables gained
+        self.trace = opts.get("trace", False)
 
         self.reporting_hooks = {'made-choice': [], 'found': []}
 
@@ -183,254 +327,808 @@ class SimulationSingle:
         if opts.get("summarize", False):
             self.summarize() 
 
+    @property
+    def found(self):
+        return self.compiled.compiled_base.decode(self.state.found)
+
+    @property
+    def unlocks(self):
+        return self.compiled.compiled_base.decode(self.state.unlocks)
+
+    @property
+    def unlockables(self):
+        return self.compiled.compiled_base.decode(self.state.unlockables)
+
     def _init_reports(self):
-        for r in self.sim["reports"]:
+        for i in range(len(self.sim["reports"])):
+            r = self.sim["reports"][i]
             self.reports[r["label"]] = self.reports.get(r["label"],[])
-            report = get_report(r)
+            if self.reporters is None:
+                report = get_report(r)
+            else:
+                report = self.reporters[i]
+                report.reset()
             for hook_type in self.reporting_hooks.keys():
                 if hook_type in report.supported_hooks:
                     self.reporting_hooks[hook_type].append(report)
 
-    def _initial_found(self):
-        if self._initf is None:
-            self._initf = [self.choices[k] for k in self.base["initial"].keys()]
-        return self._initf
-
     def _init_lists(self):
-        self.found = self._initial_found()
-        for hook in self.reporting_hooks['found']:
-            for findable in self.found:
-                self.reports = hook.found(self.reports, findable)
-        self.update_lists()
+        (u1, f, u2) = self.compiled.initial()
+        self.state.reset(u1, f, u2)
+        if self.opts.get("summarize", False):
+            self._summarize_new(f, u1, u2)
+        self._found_hooks(f)
 
     def _update_choice_count(self):
         self.reports["choice_count"] = len(self.reports.get("choices", []))
 
     def summarize(self):
-        print("Available: " + ", ".join(set(self.unlockables) - set(self.unlocks)))
+        print("Available: " + ", ".join(self.compiled.compiled_base.decode(self.state.available())))
         print("Done:      " + ", ".join(self.unlocks))
         print("Found:     " + ", ".join(self.found))
 
-    def _found_findables(self, unlocks):
-        return self._initial_found() + [self.choices[k] for k in unlocks if k in self.choices]
-
-    def _findable_unlocks(self, found, unlocks):
-        u = []
-        for f_name in found:
-            found_obj = self.base["findables"].get(f_name, {})
-            if "unlocks" in found_obj:
-                u.extend(found_obj["unlocks"])
-        for u_name in unlocks:
-            unlock_obj = self.base["unlockables"].get(u_name, {})
-            if "unlocks" in unlock_obj:
-                u.extend(unlock_obj["unlocks"])
-        return u
-
-    def _find_unlockables(self, unlocks, found):
-        u = []
-        got = set(unlocks) | set(found)
-        for unlockable_name, unlockable in self.base["unlockables"].items():
-            #unlockable = self.base["unlockables"][unlockable_name]
-            if 'requirements' in unlockable:
-                req = unlockable["requirements"]
-                if isinstance(req, str) and _strmet(req, got):
-                    u.append(unlockable_name)
-                elif isinstance(req, list):
-                    if meets_and_req(req, got):
-                        u.append(unlockable_name)
-                elif isinstance(req, dict):
-                    if ("and" in req) and ("or" not in req):
-                        # and-only, probably with nested or
-                        if meets_and_req(req["and"], got):
-                            u.append(unlockable_name)
-                    elif ("or" in req) and ("and" not in req):
-                        # or-only, maybe with nested ands
-                        if meets_or_req(req["or"], got):
-                            u.append(unlockable_name)
-                    elif ("or" in req) and ("and" in req):
-                        # both parts
-                        if meets_and_req(req["and"], got) and meets_or_req(req["or"], got):
-                            u.append(unlockable_name)
-            else:
-                u.append(unlockable_name)
-        return u
+    def _summarize_new(self, new_f, new_u1, new_u2):
+        names = self.compiled.compiled_base.decode
+        if new_u1:
+            print("New unlocks:     " + ", ".join(names(new_u1)))
+        if new_u2:
+            print("New unlockables: " + ", ".join(names(new_u2)))
+        if new_f:
+            print("New findables:   " + ", ".join(names(new_f)))
 
-    def _updated_lists(self, found, unlocks, unlockables):
-        f = copy.copy(found)
-        u1 = copy.copy(unlocks)
-        u2 = copy.copy(unlockables)
+    def _found_hooks(self, new_found):
+        if new_found and self.reporting_hooks['found']:
+            for findable in self.compiled.found_order(new_found):
+                for hook in self.reporting_hooks['found']:
+                    self.reports = hook.found(self.reports, findable)
 
-        new_u1 = self._findable_unlocks(found, unlocks)
-        u1 = u1 + list(set(new_u1) - set(u1))
-        changed_u1 = (len(u1) != len(unlocks))
+    def _trace_start(self):
+        # [trace]: available (per choice, the unlockables it was picked from),
+        # found (names, in the order the found hooks saw them) and found_counts
+        # (how many of them came before the first choice, then after each one)
+        found = self.compiled.found_order(self.state.found)
+        self.reports["trace"] = {"available": [], "found": found, "found_counts": [len(found)]}
 
-        new_u2 = self._find_unlockables(unlocks, found)
-        u2 = u2 + list(set(new_u2) - set(u2))
-        changed_u2 = (len(u2) != len(new_u2))
+    def _trace_step(self, available, new_found):
+        trace = self.reports["trace"]
+        new_names = self.compiled.found_order(new_found)
+        trace["available"].append(bin(available).count("1"))
+        trace["found"].extend(new_names)
+        trace["found_counts"].append(len(new_names))
 
-        new_f = self._found_findables(unlocks)
-        f = f + list(set(new_f) - set(f))
-        changed_f = (len(f) != len(found))
+    def _instrument_step(self, t0, t1, t2, t3, t4, new_found):
+        instruments = self.instruments
+        instruments.add_time("choose", t1 - t0)
+        instruments.add_time("closure", t3 - t2)
+        instruments.add_time("report hooks", (t2 - t1) + (t4 - t3))
+        instruments.count("choices")
+        instruments.count("report hook calls", len(self.reporting_hooks['made-choice']) + bin(new_found).count("1") * len(self.reporting_hooks['found']))
 
-        if self.opts.get("summarize", False):
-            if changed_u1:
-                new = set(u1) - set(unlocks)
-                print("New unlocks:     " + ", ".join(new))
+    def run(self):
+        # the one place runs are stepped: choose, made-choice hooks, advance,
+        # found hooks (exact.py and replay.py follow this order). Timing
+        # (with instruments) and the trace (with the "trace" opt) hang off it
+        state = self.state
+        names = self.compiled.compiled_base.names
+        instrumented = self.instruments is not None
+        clock = time.perf_counter if instrumented else _no_clock
+        trace = self.trace
+        summarize = self.opts.get("summarize", False)
+        advance = self.compiled.advance
+        choose_id = self.strategy.choose_id
+        rng = self.rng
+        made_choice_hooks = self.reporting_hooks['made-choice']
+        if trace:
+            self._trace_start()
+        while not (state.unlocks & self._end_mask):
+            available = state.available()
+            t0 = clock()
+            next_unlock = choose_id(available, rng)
+            t1 = clock()
+            state.choose(next_unlock)
+            for hook in made_choice_hooks:
+                self.reports = hook.made_choice(self.reports, names[next_unlock])
+            t2 = clock()
+            (u1, f, u2, new_f) = advance(state.unlocks, state.found, state.unlockables, 1 << next_unlock)
+            if summarize:
+                self._summarize_new(new_f, u1 & ~state.unlocks, u2 & ~state.unlockables)
+            (state.unlocks, state.found, state.unlockables) = (u1, f, u2)
+            t3 = clock()
+            self._found_hooks(new_f)
+            if instrumented:
+                self._instrument_step(t0, t1, t2, t3, clock(), new_f)
+            if trace:
+                self._trace_step(available, new_f)
+        if instrumented:
+            self.instruments.count("runs")
+        self.reports["choices"] = [names[c] for c in state.history]
+        self._update_choice_count()
 
-            if changed_u2:
-                new = set(u2) - set(unlockables)
-                print("New unlockables: " + ", ".join(new))
+def simulation_label(simulation, sim):
+    return simulation.get("label", str(sim["simulations"].index(simulation)))
 
-            if changed_f:
-                new = set(f) - set(found)
-                print("New findables:   " + ", ".join(new))
+def simulation_engine(simulation, opts):
+    # only the scalar engine records traces
+    if opts.get("trace"):
+        return "scalar"
+    return simulation.get("engine", opts.get("engine", "scalar"))
 
-        if changed_u1 or changed_u2 or changed_f:
-            #print("  ...") if self.opts.get("summarize", False)
-            (f, u1, u2) = self._updated_lists(f, u1, u2)
+def simulation_exact(simulation, opts):
+    return simulation.get("exact", opts.get("exact", False))
 
-        return (f, u1, u2)
+def expected_runs(simulation, opts):
+    # the most runs a simulation can take: count, or max-count with a target-ci
+    count = simulation.get("count", 1)
+    if simulation.get("target-ci", opts.get("target-ci")) is not None and not simulation_exact(simulation, opts):
+        return simulation.get("max-count", opts.get("max-count", count))
+    return count
 
-    def update_lists(self):
-        (f, u1, u2) = self._updated_lists(self.found, self.unlocks, self.unlockables)
-        if len(f) != len(self.found):
-            for hook in self.reporting_hooks['found']:
-                for findable in list(set(f) - set(self.found)):
-                    self.reports = hook.found(self.reports, findable)
-        (self.found, self.unlocks, self.unlockables) = (f, u1, u2)
+def run_exact(sim, simulation, compiled, strategy, opts={}, instruments=None):
+    # outcome probabilities for a whole simulation, or None if it has too many
+    # states and has to be sampled after all
+    from .exact import ExactSimulation
+    max_states = simulation.get("max-states", opts.get("max-states"))
+    exact = ExactSimulation(compiled, sim, strategy, 100000 if max_states is None else max_states)
+    compiled.stats = instruments
+    start = time.perf_counter()
+    outcomes = exact.run()
+    compiled.stats = None
+    if instruments is not None:
+        instruments.add_time("exact", time.perf_counter() - start)
+        instruments.count("exact states", exact.states)
+    if outcomes is None:
+        return None
+    return {"states": exact.states, "outcomes": outcomes}
 
-    def choose_unlockable(self):
-        available = list(set(self.unlockables) - set(self.unlocks))
-        sim = get_sim(self.simulation)
-        return sim.choose(available)
+def run_simulations(base, sim, simulation, compiled, strategy, seeds, opts={}, instruments=None):
+    # do one run of simulation per seed in this process, returning each run's reports
+    if simulation_engine(simulation, opts) == "batch":
+        # imported here so numpy is only needed when the batch engine is used
+        from .batch import BatchSimulation
+        if instruments is None:
+            return BatchSimulation(compiled, sim, strategy).run(seeds)
+        with instruments.timer("batch"):
+            res = BatchSimulation(compiled, sim, strategy).run(seeds)
+        instruments.count("runs", len(seeds))
+        return res
+    res = []
+    # runs are done one after another, so they can share one run state and
+    # one set of (compiled) report objects
+    state = RunState()
+    reporters = [get_report(r) for r in sim["reports"]]
+    compiled.stats = instruments
+    for seed in seeds:
+        run = SimulationSingle(base, sim, simulation, compiled.choices, opts, compiled, strategy, state, seed, reporters, instruments)
+        run.run()
+        res.append(run.reports)
+    compiled.stats = None
+    return res
 
-    def run(self):
-        while len([e for e in self.sim["end-states"] if e in self.unlocks]) == 0:
-            #print("----------") if self.opts.get("summarize", False)
-            next_unlock = self.choose_unlockable()
-            #print("Next unlock: " + next_unlock) if self.opts.get("summarize", False)
-            self.unlocks.append(next_unlock)
-            self.reports["choices"].append(next_unlock)
-            for hook in self.reporting_hooks['made-choice']:
-                self.reports = hook.made_choice(self.reports, next_unlock)
-            self.update_lists()
-            #self.summarize() if self.opts.get("summarize", False)
-        #print("==========") if self.opts.get("summarize", False)
-        self._update_choice_count()
+### Choices sources
+#
+# Choices come from a file name, or from a (name, choices) pair for choices
+# built in memory (see generate.py); a list of sources can be any sequence
+# of these, and may have a names() method that saves loading each one.
 
-def simulation_label(simulation, sim):
-    return simulation.get("label", str(sim["simulations"].index(simulation)))
+def memo_size(opts):
+    # states to memoize per choices source (CompiledChoices.advance)
+    return opts.get("memo-size", 65536)
+
+def load_choices(source):
+    if isinstance(source, str):
+        with open(source, 'r') as f:
+            return (source, parse_file(f))
+    return source
+
+def choices_names(sources):
+    if hasattr(sources, "names"):
+        return sources.names()
+    return [s if isinstance(s, str) else s[0] for s in sources]
+
+### Worker processes
+#
+# Workers get the bases, sims and choices sources once, from the pool
+# initializer, and load and compile each choices source the first time a task
+# needs it. A cell is a (base index, sim index) pair, so one pool can run every
+# base against every sim. Tasks are (cell, file index, simulation index, seed,
+# start, stop) and results come back compacted: choices as unlockable ids and
+# report categories as indexes into that report's categories.
+
+_worker = {}
 
-def sim_report(simulation_single):
-    simulation_single.run()
-    return simulation_single.reports
+def init_worker(bases, sims, choice_files, opts):
+    _worker["bases"] = bases
+    _worker["sims"] = sims
+    _worker["choice_files"] = choice_files
+    _worker["opts"] = opts
+    _worker["compiled_bases"] = [CompiledBase(base) for base in bases]
+    _worker["choices"] = collections.OrderedDict()
+    _worker["compiled"] = collections.OrderedDict()
+    if opts.get("profile-dir") is not None:
+        import cProfile
+        _worker["profile"] = cProfile.Profile()
+
+# rough cost of a simulation step, and how much work it takes before
+# starting worker processes (and sending them everything) pays off
+STEP_SECONDS = 2e-5
+POOL_MIN_SECONDS = 1.0
+
+def pool_size(bases, sims, choice_files, opts={}):
+    # worker processes to use, 0 to run everything in this process: the
+    # "processes" opt if given, otherwise CPU count minus 2 if the runs look
+    # like they'd take long enough (at worst a step per unlockable each)
+    if opts.get("processes") is not None:
+        return opts["processes"]
+    processes = max(1, os.cpu_count() - 2)
+    runs = len(choice_files) * sum(expected_runs(simulation, opts) for sim in sims for simulation in sim["simulations"])
+    steps = runs * sum(len(base["unlockables"]) for base in bases)
+    if processes == 1 or steps * STEP_SECONDS < POOL_MIN_SECONDS:
+        return 0
+    return processes
+
+def worker_pool(bases, sims, choice_files, opts={}):
+    import multiprocessing
+    processes = opts.get("processes", max(1, os.cpu_count() - 2))
+    return multiprocessing.Pool(processes, initializer=init_worker, initargs=(bases, sims, choice_files, opts))
+
+def _lru_get(cache, key, make, size=16):
+    entry = cache.get(key)
+    if entry is None:
+        entry = make()
+        cache[key] = entry
+        if len(cache) > size:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    return entry
+
+def _worker_compiled(base_index, file_index):
+    # the most recently used choices sources stay loaded, and compiled
+    # against each base with their memos
+    def compile_choices():
+        (name, choices) = _lru_get(_worker["choices"], file_index, lambda: load_choices(_worker["choice_files"][file_index]))
+        return (name, _worker["compiled_bases"][base_index].compile_choices(choices, memo_size(_worker["opts"])))
+    return _lru_get(_worker["compiled"], (base_index, file_index), compile_choices)
+
+def compact_reports(reports, sim, compiled_base):
+    ids = compiled_base.ids
+    categories = [[c for c in report["categories"].keys()] for report in sim["reports"]]
+    # a trace goes as it is: choices files can add findables, which then
+    # have different ids in each process
+    return (array.array('i', [ids[c] for c in reports["choices"]]),
+            tuple(tuple(categories[r].index(c) for c in reports[sim["reports"][r]["label"]]) for r in range(len(sim["reports"]))),
+            reports.get("trace"))
+
+def expand_reports(compact, sim, compiled_base, seed=None):
+    names = compiled_base.names
+    (choices, matched, trace) = compact
+    reports = {"choices": [names[c] for c in choices], "choice_count": len(choices)}
+    if seed is not None:
+        reports["seed"] = seed
+    if trace is not None:
+        reports["trace"] = trace
+    for r in range(len(sim["reports"])):
+        categories = list(sim["reports"][r]["categories"].keys())
+        reports[sim["reports"][r]["label"]] = [categories[c] for c in matched[r]]
+    return reports
+
+def run_task(task):
+    profile = _worker.get("profile")
+    if profile is None:
+        return _run_task(task)
+    # profile every task, adding up in one profile per worker process
+    profile.enable()
+    try:
+        return _run_task(task)
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(_worker["opts"]["profile-dir"], "worker-%d.prof" % os.getpid()))
+
+def _run_task(task):
+    (cell, file_index, sim_index, seed, start, stop) = task
+    task_start = time.perf_counter()
+    instruments = Instruments() if _worker["opts"].get("instrument") else None
+    base = _worker["bases"][cell[0]]
+    sim = _worker["sims"][cell[1]]
+    (name, compiled) = _worker_compiled(cell[0], file_index)
+    simulation = sim["simulations"][sim_index]
+    strategy = get_sim(simulation, compiled.compiled_base)
+    if simulation_exact(simulation, _worker["opts"]) and (start, stop) == (0, simulation.get("count", 1)):
+        exact = run_exact(sim, simulation, compiled, strategy, _worker["opts"], instruments)
+        if exact is not None:
+            return ((cell, file_index, sim_index, start), exact, _task_instruments(instruments, task_start))
+    label = simulation_label(simulation, sim)
+    seeds = [run_seed(seed, name, label, i) for i in range(start, stop)]
+    res = run_simulations(base, sim, simulation, compiled, strategy, seeds, _worker["opts"], instruments)
+    compacts = [compact_reports(r, sim, compiled.compiled_base) for r in res]
+    return ((cell, file_index, sim_index, start), compacts, _task_instruments(instruments, task_start))
+
+def _task_instruments(instruments, task_start):
+    if instruments is None:
+        return None
+    instruments.count("worker tasks")
+    instruments.add_time("worker tasks", time.perf_counter() - task_start)
+    return instruments.to_dict()
+
+def chunk_size(count, opts={}):
+    # aim for several chunks per worker so they even out, unless told otherwise
+    if opts.get("chunk-size") is not None:
+        return opts["chunk-size"]
+    return max(1, count // (8 * max(1, opts.get("processes", os.cpu_count()))))
 
 class SimulationRun:
-    def __init__(self, base, sim, simulation, choices, pool=None, opts={}):
-        self.reports = {"raw": {}, "summary": {}}
+    def __init__(self, base, sim, simulation, choices, pool=None, opts={}, compiled=None, file_index=None, file_name=None, output=None, cache=None, progress=None, cell=(0, 0)):
+        self.keep_raw = opts.get("keep-raw", False)
+        self.reports = {"raw": {}, "summary": {}} if self.keep_raw else {"summary": {}}
         self.base = base
         self.sim = sim
         self.simulation = simulation
         self.choices = choices
         self.opts = opts
         self.pool = pool
+        if compiled is None:
+            compiled = CompiledBase(base).compile_choices(choices)
+        self.compiled = compiled
+        self.strategy = get_sim(simulation, compiled.compiled_base)
+        # index of the choices file in the worker pool's list, if there is a
+        # pool, and of the base and sim in its lists
+        self.file_index = file_index
+        self.cell = cell
+        self.file_name = file_name
         self.label = simulation_label(self.simulation, self.sim)
+        # master seed for this simulation's runs; with none given pick one, so
+        # the per-run seeds in the reports can still replay any run.
+        # [seed] records it, so the whole simulation can be rerun with it too
+        self.seed = simulation.get("seed", opts.get("seed"))
+        if self.seed is None:
+            self.seed = random.getrandbits(64)
+        self.reports["seed"] = self.seed
+        self.accumulators = {}
+        self.exact = simulation_exact(simulation, opts)
+        # with a target-ci, runs go in batches until every category's
+        # interval is at most that wide either side, or max-count runs are done
+        self.target_ci = simulation.get("target-ci", opts.get("target-ci"))
+        self.max_count = expected_runs(simulation, opts) if self.target_ci is not None else self.count()
+        self.batch_size = simulation.get("batch-size", opts.get("batch-size", 100))
+        # runs handed out so far
+        self.planned = 0
+        # run writer (e.g. output.NpzRunWriter) that gets every run's reports
+        self.output = output
+        # result cache (cache.ResultCache) to reuse this unit from and store it in
+        self.cache = cache
+        self.cached = False
+        self.instruments = Instruments() if opts.get("instrument") else None
+        # progress.Progress to tell about runs done, if showing progress
+        self.progress = progress
 
-    def run(self):
+    def start(self):
         #simulation_label = self.simulation.get("label", str(self.sim["simulations"].index(simulation)))
         #self.reports[simulation_label] = self.reports.get(simulation_label, {})
-        print("SIM: " + simulation_label(self.simulation, self.sim),file=sys.stderr)
-        for r in self.sim["reports"]:
-            self.reports["raw"][r["label"]] = []
-        runs = []
-        for i in range(self.simulation.get("count", 1)):
-            run = SimulationSingle(self.base, self.sim, self.simulation, self.choices, self.opts)
-            runs.append(run)
-        if self.pool is not None:
-            res = self.pool.map(sim_report, runs)
-            for i in range(len(runs)):
-                self.reports[i] = res[i] 
-                for r in self.sim["reports"]:
-                    self.reports["raw"][r["label"]].append(res[i][r["label"]])
-        else:
-            for i in range(len(runs)):
-                run = runs[i]
-                run.run()
-                self.reports[i] = run.reports
-                for r in self.sim["reports"]:
-                    # raw data across all runs of a simulation in a single file
-                    # [raw][<report label>]
-                    self.reports["raw"][r["label"]].append(run.reports[r["label"]])
         for r in self.sim["reports"]:
             summarizer = get_report(r)
             if summarizer is not None:
-                # summary data across all runs of a single simulation in a single file
-                # [summary][<report label>]
-                self.reports["summary"][r["label"]] = summarizer.summarize_raw_data(self.reports["raw"][r["label"]])
+                self.accumulators[r["label"]] = summarizer.accumulator()
+
+    def count(self):
+        return self.simulation.get("count", 1)
+
+    def cache_key(self):
+        # everything the results depend on; not the engine, which only
+        # changes how fast. The seeds come from the file name, but only
+        # matter if the master seed was given rather than picked at random
+        from .cache import unit_key
+        seeded = self.simulation.get("seed", self.opts.get("seed")) is not None
+        return unit_key({
+            "base": self.base,
+            "end-states": self.sim["end-states"],
+            "reports": self.sim["reports"],
+            "simulation": self.simulation,
+            "label": self.label,
+            "choices": self.choices,
+            "file": self.file_name if seeded else None,
+            "seed": self.seed if seeded else None,
+            "options": {key: self.opts.get(key) for key in ["exact", "max-states", "target-ci", "max-count", "batch-size"]},
+        })
+
+    def load_cached(self):
+        # runs kept with keep-raw aren't cached, so those units always run
+        if self.cache is None or self.keep_raw:
+            return False
+        result = self.cache.get(self.cache_key())
+        if result is None:
+            return False
+        if self.progress is not None:
+            self.progress.finish_unit(self.file_index, expected_runs(self.simulation, self.opts), 0)
+        self.reports = result["reports"]
+        self.accumulators = {label: QualitativeAccumulator.from_dict(acc) for (label, acc) in result["accumulators"].items()}
+        self.cached = True
+        return True
+
+    def store_cached(self):
+        reports = {key: value for (key, value) in self.reports.items() if key in ["seed", "summary", "exact", "target-ci"]}
+        accumulators = {label: acc.to_dict() for (label, acc) in self.accumulators.items()}
+        self.cache.put(self.cache_key(), self.file_name, self.label, {"reports": reports, "accumulators": accumulators})
+
+    def adaptive(self):
+        return self.target_ci is not None and not self.exact
+
+    def converged(self):
+        for r in self.sim["reports"]:
+            acc = self.accumulators.get(r["label"])
+            if acc is not None and any(acc.half_width(c) > self.target_ci for c in r["categories"].keys()):
+                return False
+        return True
+
+    def next_tasks(self, size):
+        # tasks for the runs still to do: all of them the first time, or with
+        # a target-ci, the next batch once the previous one is all in
+        sim_index = self.sim["simulations"].index(self.simulation)
+        stop = self.count()
+        if self.exact:
+            # one task for the whole simulation, which samples it in one go
+            # if it turns out to have too many states
+            size = max(1, self.count())
+        elif self.adaptive():
+            stop = self.planned
+            if self.planned == 0 or not self.converged():
+                stop = min(self.max_count, self.planned + self.batch_size)
+            size = min(size, chunk_size(self.batch_size, self.opts))
+        tasks = [(self.cell, self.file_index, sim_index, self.seed, start, min(stop, start + size)) for start in range(self.planned, stop, size)]
+        self.planned = max(self.planned, stop)
+        return tasks
+
+    def run_seed(self, index):
+        return run_seed(self.seed, self.file_name, self.label, index)
+
+    def add_result(self, index, reports):
+        for (label, acc) in self.accumulators.items():
+            acc.update(reports[label])
+        if self.keep_raw:
+            self.reports[index] = reports
+        if self.output is not None:
+            self.output.add(self.file_index, self.sim["simulations"].index(self.simulation), index, reports)
+
+    def add_exact(self, exact):
+        # every outcome weighted by its probability, scaled to count runs
+        self.reports["exact"] = {"states": exact["states"]}
+        for (matched, p) in exact["outcomes"].items():
+            for (r, report) in enumerate(self.sim["reports"]):
+                if report["label"] in self.accumulators:
+                    self.accumulators[report["label"]].update(list(matched[r]), p * self.count())
+
+    def add_results(self, start, compacts, instruments=None):
+        # one task's results, with the worker's instruments if instrumenting
+        if self.instruments is not None:
+            if instruments is not None:
+                self.instruments.merge(Instruments.from_dict(instruments))
+            aggregation_start = time.perf_counter()
+        if isinstance(compacts, dict):
+            self.add_exact(compacts)
+        else:
+            for j in range(len(compacts)):
+                self.add_result(start + j, expand_reports(compacts[j], self.sim, self.compiled.compiled_base, self.run_seed(start + j)))
+        if self.instruments is not None:
+            self.instruments.add_time("aggregation", time.perf_counter() - aggregation_start)
+        if self.progress is not None:
+            self.progress.add(self.file_index, self.count() if isinstance(compacts, dict) else len(compacts))
+
+    def finish(self):
+        if self.cached:
+            return
+        if self.exact and "exact" not in self.reports:
+            # too many states, so it was sampled
+            self.reports["exact"] = False
+        if self.progress is not None:
+            self.progress.finish_unit(self.file_index, expected_runs(self.simulation, self.opts), self.count() if self.reports.get("exact") else self.planned)
+        if self.adaptive():
+            self.reports["target-ci"] = {"runs": self.planned, "converged": self.converged()}
+        if self.keep_raw:
+            for r in self.sim["reports"]:
+                # raw data across all runs of a simulation in a single file
+                # [raw][<report label>]; there are no runs to list if it was exact
+                if self.reports.get("exact"):
+                    self.reports["raw"][r["label"]] = []
+                else:
+                    self.reports["raw"][r["label"]] = [self.reports[i][r["label"]] for i in range(self.planned)]
+        aggregation_start = time.perf_counter()
+        for (label, acc) in self.accumulators.items():
+            # summary data across all runs of a single simulation in a single file
+            # [summary][<report label>]
+            self.reports["summary"][label] = acc.finish()
+        if self.instruments is not None:
+            self.instruments.add_time("aggregation", time.perf_counter() - aggregation_start)
+            self.reports["instruments"] = self.instruments.to_dict()
+        if self.cache is not None:
+            self.store_cached()
+
+    def run(self):
+        print("SIM: " + self.label,file=sys.stderr)
+        self.start()
+        if self.load_cached():
+            return
+        size = chunk_size(self.count(), self.opts)
+        if self.exact:
+            exact = run_exact(self.sim, self.simulation, self.compiled, self.strategy, self.opts, self.instruments)
+            if exact is not None:
+                self.add_results(0, exact)
+                self.finish()
+                return
+        tasks = self.next_tasks(size)
+        while tasks:
+            if self.pool is not None and self.file_index is not None:
+                for ((_, _, _, start), compacts, instruments) in self.pool.imap_unordered(run_task, tasks):
+                    self.add_results(start, compacts, instruments)
+            else:
+                for (_, _, _, _, start, stop) in tasks:
+                    seeds = [self.run_seed(i) for i in range(start, stop)]
+                    res = run_simulations(self.base, self.sim, self.simulation, self.compiled, self.strategy, seeds, self.opts, self.instruments)
+                    aggregation_start = time.perf_counter()
+                    for j in range(len(res)):
+                        self.add_result(start + j, res[j])
+                    if self.instruments is not None:
+                        self.instruments.add_time("aggregation", time.perf_counter() - aggregation_start)
+                    if self.progress is not None:
+                        self.progress.add(self.file_index, len(res))
+            tasks = self.next_tasks(size)
+        self.finish()
+
+def merge_accumulators(sim, sources):
+    # one fresh accumulator per report, merged from each source's accumulators
+    accumulators = {}
+    for r in sim["reports"]:
+        summarizer = get_report(r)
+        if summarizer is not None:
+            acc = summarizer.accumulator()
+            for source in sources:
+                acc.merge(source[r["label"]])
+            accumulators[r["label"]] = acc
+    return accumulators
 
 class FileSimulator:
-    def __init__(self, fname, base, sim, pool=None, opts={}):
-        self.reports = {"simulations": {}, "raw": {}, "summary": {}}
-        self.fname = fname
+    def __init__(self, source, base, sim, pool=None, opts={}, compiled_base=None, file_index=None, output=None, cache=None, progress=None, cell=(0, 0)):
+        self.keep_raw = opts.get("keep-raw", False)
+        self.reports = {"simulations": {}, "raw": {}, "summary": {}} if self.keep_raw else {"simulations": {}, "summary": {}}
+        (self.fname, self.choices) = load_choices(source)
+        self.file_index = file_index
         self.base = base
         self.sim = sim
         self.pool = pool
         self.opts = opts
-        with open(fname, 'r') as f:
-            self.choices = parse_file(f)
+        if compiled_base is None:
+            compiled_base = CompiledBase(base)
+        self.compiled = compiled_base.compile_choices(self.choices, memo_size(opts))
+        self.runs = None
+        self.accumulators = {}
+        self.instruments = None
+        self.output = output
+        self.cache = cache
+        self.progress = progress
+        self.cell = cell
         if opts.get("summarize", False):
             summary.summarize_options(self.base, choices=self.choices)
 
     def simulation(self, index):
-        return SimulationRun(self.base, self.sim, self.sim["simulations"][index], self.choices, self.pool, self.opts)
+        return SimulationRun(self.base, self.sim, self.sim["simulations"][index], self.choices, self.pool, self.opts, self.compiled, self.file_index, self.fname, self.output, self.cache, self.progress, self.cell)
 
-    def run(self):
-        print("FILE: " + self.fname,file=sys.stderr)
-        for s in range(len(self.sim["simulations"])):
-            simulation = self.simulation(s)
-            label = simulation.label
-            simulation.run()
-            self.reports["simulations"][label] = simulation.reports
+    def simulation_runs(self):
+        if self.runs is None:
+            self.runs = [self.simulation(s) for s in range(len(self.sim["simulations"]))]
+        return self.runs
+
+    def finish(self):
+        for simulation in self.simulation_runs():
+            self.reports["simulations"][simulation.label] = simulation.reports
+        # summary data across all runs of _all_ simulations in a single file
+        # [summary][<report label>], plus [raw][<report label>] if keeping raw data
+        self.accumulators = merge_accumulators(self.sim, [simulation.accumulators for simulation in self.simulation_runs()])
+        if self.opts.get("instrument"):
+            self.instruments = merge_instruments([simulation.instruments for simulation in self.simulation_runs()])
+            self.reports["instruments"] = self.instruments.to_dict()
         for r in self.sim["reports"]:
             summarizer = get_report(r)
             if summarizer is not None:
-                # raw and summary data across all runs of _all_ simulations in a single file
-                # [raw][<report label>] and [summary][<report label>]
-                self.reports["raw"][r["label"]] = summarizer.combine_simulations(self.reports, r["label"])
-                self.reports["summary"][r["label"]] = summarizer.summarize_raw_data(self.reports["raw"][r["label"]])
+                if self.keep_raw:
+                    self.reports["raw"][r["label"]] = summarizer.combine_simulations(self.reports, r["label"])
+                self.reports["summary"][r["label"]] = self.accumulators[r["label"]].finish()
         sys.stderr.flush()
 
+    def run(self):
+        print("FILE: " + self.fname,file=sys.stderr)
+        for simulation in self.simulation_runs():
+            simulation.run()
+        self.finish()
+
+def run_scheduled(simulators, pool, opts={}, instruments=None):
+    # every (cell, file, simulation, run range) of the RandomizerSimulators
+    # goes into one queue, so workers stay busy across simulation, file and
+    # cell boundaries. Simulations with a target-ci put their next batch in
+    # the following round's queue
+    cells = {}
+    runs = {}
+    remaining = {}
+    total = 0
+    for simulator in simulators:
+        cells[simulator.cell] = simulator
+        simulator.file_simulators = [simulator.file_simulator(i) for i in range(len(simulator.filenames))]
+        for (file_index, file_simulator) in enumerate(simulator.file_simulators):
+            for (sim_index, simulation) in enumerate(file_simulator.simulation_runs()):
+                runs[(simulator.cell, file_index, sim_index)] = simulation
+                total += simulation.count()
+            remaining[(simulator.cell, file_index)] = len(simulator.sim["simulations"])
+    size = chunk_size(total, opts)
+    tasks = []
+    left = {}
+    for (key, simulation) in runs.items():
+        simulation.start()
+        unit_tasks = [] if simulation.load_cached() else simulation.next_tasks(size)
+        left[key] = len(unit_tasks)
+        tasks.extend(unit_tasks)
+
+    def unit_done(key):
+        runs[key].finish()
+        remaining[key[:2]] -= 1
+        if remaining[key[:2]] == 0:
+            file_simulator = cells[key[0]].file_simulators[key[1]]
+            print("FILE: " + file_simulator.fname, file=sys.stderr)
+            file_simulator.finish()
+
+    for key in [k for k in left.keys() if left[k] == 0]:
+        unit_done(key)
+    while tasks:
+        next_round = []
+        results = pool.imap_unordered(run_task, tasks)
+        while True:
+            # time spent waiting on workers, as opposed to handling results
+            wait_start = time.perf_counter()
+            result = next(results, None)
+            if instruments is not None:
+                instruments.add_time("pool wait", time.perf_counter() - wait_start)
+            if result is None:
+                break
+            ((cell, file_index, sim_index, start), compacts, task_instruments) = result
+            if instruments is not None:
+                instruments.count("pool tasks")
+            key = (cell, file_index, sim_index)
+            runs[key].add_results(start, compacts, task_instruments)
+            left[key] -= 1
+            if left[key] == 0:
+                unit_tasks = runs[key].next_tasks(size)
+                left[key] = len(unit_tasks)
+                next_round.extend(unit_tasks)
+                if left[key] == 0:
+                    unit_done(key)
+        tasks = next_round
+
 class RandomizerSimulator:
-    def __init__(self, choice_files, base, sim, pool=None, opts={}):
-        self.reports = {"files": {}, "simulations": {}, "raw": {}, "summary": {}}
+    def __init__(self, choice_files, base, sim, pool=None, opts={}, output=None, cache=None, cell=(0, 0), name=None):
+        self.keep_raw = opts.get("keep-raw", False)
+        self.reports = {"files": {}, "simulations": {}, "raw": {}, "summary": {}} if self.keep_raw else {"files": {}, "simulations": {}, "summary": {}}
         self.filenames = choice_files
         self.base = base
         self.sim = sim
         self.pool = pool
         self.opts = opts
+        self.compiled_base = CompiledBase(base)
+        self.file_simulators = []
+        self.output = output
+        self.cache = cache
+        # position in a MatrixSimulator's bases and sims, and what to call it
+        self.cell = cell
+        self.name = name
+        # pool dispatch and return, which isn't any one simulation's
+        self.instruments = Instruments() if opts.get("instrument") else None
+        self.progress = None
+        if opts.get("progress") is not None:
+            from .progress import Progress
+            per_file = sum(expected_runs(simulation, opts) for simulation in sim["simulations"])
+            self.progress = Progress(choices_names(choice_files), [per_file] * len(choice_files), opts["progress"], opts.get("partial-summaries"), self.partial_accumulators, label=name)
 
     def file_simulator(self, file_index):
-        return FileSimulator(self.filenames[file_index], self.base, self.sim, self.pool, self.opts)
+        return FileSimulator(self.filenames[file_index], self.base, self.sim, self.pool, self.opts, self.compiled_base, file_index, self.output, self.cache, self.progress, self.cell)
+
+    def partial_accumulators(self):
+        # everything so far, merged into fresh accumulators
+        return merge_accumulators(self.sim, [run.accumulators for f in self.file_simulators for run in f.simulation_runs() if run.accumulators])
 
     def run(self):
-        for file_index in range(len(self.filenames)):
-            fname = self.filenames[file_index]
-            file_simulator = self.file_simulator(file_index)
-            file_simulator.run()
-            self.reports["files"][fname] = file_simulator.reports
-        for sl in [simulation_label(simulation, self.sim) for simulation in self.sim["simulations"]]:
-            self.reports["simulations"][sl] = {"raw": {}, "summary": {}}
+        if self.pool is not None:
+            run_scheduled([self], self.pool, self.opts, self.instruments)
+        else:
+            for file_index in range(len(self.filenames)):
+                file_simulator = self.file_simulator(file_index)
+                self.file_simulators.append(file_simulator)
+                file_simulator.run()
+        self.finish()
+
+    def finish(self):
+        if self.progress is not None:
+            self.progress.report()
+        for file_simulator in self.file_simulators:
+            self.reports["files"][file_simulator.fname] = file_simulator.reports
+        labels = [simulation_label(simulation, self.sim) for simulation in self.sim["simulations"]]
+        simulation_accumulators = {}
+        for s in range(len(labels)):
+            self.reports["simulations"][labels[s]] = {"raw": {}, "summary": {}} if self.keep_raw else {"summary": {}}
+            simulation_accumulators[labels[s]] = merge_accumulators(self.sim, [f.simulation_runs()[s].accumulators for f in self.file_simulators])
+        self.accumulators = merge_accumulators(self.sim, [f.accumulators for f in self.file_simulators])
+        if self.instruments is not None:
+            # [simulations][<simulation identifier>][instruments] across files, and [instruments] for everything
+            for s in range(len(labels)):
+                self.reports["simulations"][labels[s]]["instruments"] = merge_instruments([f.simulation_runs()[s].instruments for f in self.file_simulators]).to_dict()
+            self.reports["instruments"] = merge_instruments([self.instruments] + [f.instruments for f in self.file_simulators]).to_dict()
         for r in self.sim["reports"]:
             summarizer = get_report(r)
             if summarizer is not None:
-                # raw and summary data across all runs of each simulation, across all files
-                # [simulations][<simulation identifier>][raw][<report label>] and [summary][<report label>]
-                for s in range(len(self.sim["simulations"])):
-                    simulation = self.sim["simulations"][s]
-                    label = simulation_label(simulation, self.sim)
-                    self.reports["simulations"][label]["raw"][r["label"]] = summarizer.combine_files(self.reports, r["label"], label)
-                    self.reports["simulations"][label]["summary"][r["label"]] = summarizer.summarize_raw_data(self.reports["simulations"][label]["raw"][r["label"]])
-                # raw and summary data across all runs of all simulations across all files
-                # [raw][<report label>] and [summary][<report label>]
-                self.reports["raw"][r["label"]] = summarizer.combine_simulations(self.reports, r["label"])
-                self.reports["summary"][r["label"]] = summarizer.summarize_raw_data(self.reports["raw"][r["label"]])
+                # summary data across all runs of each simulation, across all files
+                # [simulations][<simulation identifier>][summary][<report label>], plus [raw] if keeping raw data
+                for label in labels:
+                    if self.keep_raw:
+                        self.reports["simulations"][label]["raw"][r["label"]] = summarizer.combine_files(self.reports, r["label"], label)
+                    self.reports["simulations"][label]["summary"][r["label"]] = simulation_accumulators[label][r["label"]].finish()
+                # summary data across all runs of all simulations across all files
+                # [summary][<report label>], plus [raw][<report label>] if keeping raw data
+                if self.keep_raw:
+                    self.reports["raw"][r["label"]] = summarizer.combine_simulations(self.reports, r["label"])
+                self.reports["summary"][r["label"]] = self.accumulators[r["label"]].finish()
+
+### Comparing bases and sims
+#
+# Every base against every sim file, on the same choices sources: one
+# RandomizerSimulator per (base, sim) cell, all sharing one pool and one
+# queue of tasks. The comparison puts each report's individual percentages
+# for every base side by side, per sim file, overall and per simulation.
+
+def _cell_summaries(reports, label=None):
+    if label is None:
+        return reports["summary"]
+    return reports["simulations"][label]["summary"]
+
+class MatrixSimulator:
+    def __init__(self, choice_files, bases, sims, pool=None, opts={}, cache=None, base_names=None, sim_names=None):
+        self.bases = bases
+        self.sims = sims
+        self.base_names = base_names if base_names is not None else [str(b) for b in range(len(bases))]
+        self.sim_names = sim_names if sim_names is not None else [str(s) for s in range(len(sims))]
+        self.pool = pool
+        self.opts = opts
+        self.instruments = Instruments() if opts.get("instrument") else None
+        self.cells = [RandomizerSimulator(choice_files, base, sim, pool, opts, None, cache, (b, s), self.base_names[b] + " x " + self.sim_names[s])
+                      for (b, base) in enumerate(bases) for (s, sim) in enumerate(sims)]
+        self.reports = {"cells": [], "comparison": {}}
+
+    def compare(self, cells, label=None):
+        # {report label: {category: {base name: individual percentage}}}
+        comparison = {}
+        for cell in cells:
+            base_name = self.base_names[cell.cell[0]]
+            summaries = _cell_summaries(cell.reports, label)
+            for r in cell.sim["reports"]:
+                if r["label"] in summaries:
+                    percentages = summaries[r["label"]]["individual_percentages"]
+                    categories = comparison.setdefault(r["label"], {})
+                    for category in r["categories"].keys():
+                        categories.setdefault(category, {})[base_name] = percentages.get(category, 0.0)
+        return comparison
+
+    def run(self):
+        if self.pool is not None:
+            run_scheduled(self.cells, self.pool, self.opts, self.instruments)
+            for cell in self.cells:
+                cell.finish()
+        else:
+            for cell in self.cells:
+                print("CELL: " + cell.name, file=sys.stderr)
+                cell.run()
+        for cell in self.cells:
+            (b, s) = cell.cell
+            self.reports["cells"].append({"base": self.base_names[b], "simulation": self.sim_names[s], "reports": cell.reports})
+        for (s, sim) in enumerate(self.sims):
+            cells = [cell for cell in self.cells if cell.cell[1] == s]
+            # [comparison][<sim name>][summary], and [simulations][<simulation identifier>]
+            comparison = {"summary": self.compare(cells), "simulations": {}}
+            for simulation in sim["simulations"]:
+                label = simulation_label(simulation, sim)
+                comparison["simulations"][label] = self.compare(cells, label)
+            self.reports["comparison"][self.sim_names[s]] = comparison
+        if self.instruments is not None:
+            self.reports["instruments"] = merge_instruments([self.instruments] + [Instruments.from_dict(cell.reports["instruments"]) for cell in self.cells]).to_dict()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the package isn't installed; make it importable wherever pytest runs from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
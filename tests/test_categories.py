@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from randosim.simulation import QualitativeReport
+
+# The straightforward way to check categories, as QualitativeReport did
+# before it was compiled to masks: look at every category after every hook,
+# going through its condition lists.
+class ReferenceReport:
+    def __init__(self, label, categories):
+        self.label = label
+        self.categories = categories
+        self.choices = []
+        self.founds = []
+
+    def condition_matches(self, condition):
+        if condition["type"] == "made-choice":
+            return condition["choice"] in self.choices
+        return condition["findable"] in self.founds
+
+    def category_matches(self, category):
+        if "type" in category:
+            category = {"and": [category]}
+        for c in category.get("and", []):
+            if not self.condition_matches(c):
+                return False
+        for c in category.get("and_not", []):
+            if self.condition_matches(c):
+                return False
+        if "or" in category or "or_not" in category:
+            for c in category.get("or", []):
+                if self.condition_matches(c):
+                    return True
+            for c in category.get("or_not", []):
+                if not self.condition_matches(c):
+                    return True
+            return False
+        return True
+
+    def check_categories(self, reports):
+        for (cat, category) in self.categories.items():
+            if self.category_matches(category) and cat not in reports[self.label]:
+                reports[self.label].append(cat)
+        return reports
+
+    def made_choice(self, reports, choice_made):
+        self.choices.append(choice_made)
+        return self.check_categories(reports)
+
+    def found(self, reports, findable_found):
+        self.founds.append(findable_found)
+        return self.check_categories(reports)
+
+# choices and findables share names, to check they're kept apart
+NAMES = ["a", "b", "c", "d", "e", "f"]
+
+def _condition(rng):
+    if rng.random() < 0.5:
+        return {"type": "made-choice", "choice": rng.choice(NAMES)}
+    return {"type": "got-findable", "findable": rng.choice(NAMES)}
+
+def _category(rng):
+    if rng.random() < 0.2:
+        return _condition(rng)
+    category = {}
+    for key in ["and", "and_not", "or", "or_not"]:
+        if rng.random() < 0.5:
+            category[key] = [_condition(rng) for _ in range(rng.randrange(4))]
+    return category
+
+@pytest.mark.parametrize("seed", range(200))
+def test_categories_match_reference(seed):
+    rng = random.Random(seed)
+    categories = {"cat%d" % k: _category(rng) for k in range(rng.randrange(1, 12))}
+    report = QualitativeReport("r", categories)
+    reference = ReferenceReport("r", categories)
+    (got, expected) = ({"r": []}, {"r": []})
+    # the names go past NAMES so some events touch no condition at all
+    for _ in range(rng.randrange(1, 25)):
+        name = rng.choice(NAMES + ["g", "h"])
+        if rng.random() < 0.5:
+            got = report.made_choice(got, name)
+            expected = reference.made_choice(expected, name)
+        else:
+            got = report.found(got, name)
+            expected = reference.found(expected, name)
+        assert got == expected
+
+def test_reset_starts_over():
+    categories = {"not_a": {"and_not": [{"type": "made-choice", "choice": "a"}]},
+                  "a": {"type": "made-choice", "choice": "a"}}
+    report = QualitativeReport("r", categories)
+    assert report.made_choice({"r": []}, "a") == {"r": ["a"]}
+    report.reset()
+    assert report.made_choice({"r": []}, "b") == {"r": ["not_a"]}
@@ -0,0 +1,18 @@
+import os
+
+from randosim.cmdline import make_parser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_repeated_base_and_simulation_leave_choices_alone():
+    # -b and -s take one file each, so the choices after them stay positional
+    (a, b) = (os.path.join(ROOT, "bases/jot-3.1.0.json"), os.path.join(ROOT, "bases/jot-3.1.1.json"))
+    s = os.path.join(ROOT, "sims/jot-combo.json")
+    args = make_parser().parse_args(["analyze", "-b", a, "-b", b, "-s", s, "c1.json", "c2.json"])
+    try:
+        assert [f.name for f in args.base] == [a, b]
+        assert [f.name for f in args.simulation] == [s]
+        assert args.choices == ["c1.json", "c2.json"]
+    finally:
+        for f in args.base + args.simulation:
+            f.close()
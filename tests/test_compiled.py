@@ -0,0 +1,88 @@
+import glob
+import os
+import random
+
+import pytest
+
+from randosim.compiled import CompiledBase
+from randosim.parse_file import parse_file
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASES = sorted(glob.glob(os.path.join(ROOT, "bases", "*.json")))
+
+# The original set-based requirement checks, which the compiled clauses replace
+
+def _strmet(reqstr, got):
+    return reqstr in got
+
+def meets_and_req(req, got):
+    met_reqs = []
+    for r in req:
+        if isinstance(r, str) and _strmet(r, got):
+            met_reqs.append(r)
+        elif isinstance(r, list) and meets_or_req(r, got):
+            met_reqs.append(r)
+    return (len(req) == len(met_reqs))
+
+def meets_or_req(req, got):
+    met_req = False
+    for r in req:
+        if isinstance(r, str) and _strmet(r, got):
+            met_req = True
+            break
+        elif isinstance(r, list):
+            f = meets_and_req(r, got)
+            if f:
+                met_req = f
+                break
+    return met_req
+
+def meets_requirements(unlockable, got):
+    if 'requirements' not in unlockable:
+        return True
+    req = unlockable["requirements"]
+    if isinstance(req, str):
+        return _strmet(req, got)
+    elif isinstance(req, list):
+        return meets_and_req(req, got)
+    elif isinstance(req, dict):
+        if ("and" in req) and ("or" not in req):
+            return meets_and_req(req["and"], got)
+        elif ("or" in req) and ("and" not in req):
+            return meets_or_req(req["or"], got)
+        elif ("or" in req) and ("and" in req):
+            return meets_and_req(req["and"], got) and meets_or_req(req["or"], got)
+    return False
+
+@pytest.mark.parametrize("path", BASES)
+def test_reachable_matches_requirements(path):
+    with open(path) as f:
+        base = parse_file(f)
+    compiled = CompiledBase(base)
+    rng = random.Random(path)
+    for p in [0.1, 0.3, 0.5, 0.7, 0.9]:
+        for _ in range(200):
+            got = set(name for name in compiled.names if rng.random() < p)
+            mask = compiled.mask(got)
+            for (u, name) in enumerate(compiled.unlockable_names):
+                assert compiled.reachable(u, mask) == meets_requirements(base["unlockables"][name], got), (name, sorted(got))
+
+def _with_starts(choices, start1, start2):
+    return dict(choices, start1=start1, start2=start2)
+
+def test_found_order_ignores_compile_order():
+    # names only a choices file has get ids in compile order; the found
+    # hooks should still see them in the order the file places them
+    from randosim.generate import GeneratedChoices
+    with open(os.path.join(ROOT, "bases", "jot-3.1.1.json")) as f:
+        base = parse_file(f)
+    choices = GeneratedChoices(base, 1).choices(0)
+    a = _with_starts(choices, "extra_second", "extra_first")
+    b = _with_starts(choices, "extra_first", "extra_second")
+    alone = CompiledBase(base).compile_choices(b)
+    shared = CompiledBase(base)
+    shared.compile_choices(a)
+    after = shared.compile_choices(b)
+    order = alone.found_order(alone.initial()[1])
+    assert order[-2:] == ["extra_first", "extra_second"]
+    assert after.found_order(after.initial()[1]) == order
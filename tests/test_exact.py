@@ -0,0 +1,58 @@
+import math
+import os
+
+from randosim import generate
+from randosim.compiled import CompiledBase
+from randosim.exact import ExactSimulation
+from randosim.parse_file import parse_file
+from randosim.simulation import get_sim, run_seed, run_simulations, simulation_label
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return parse_file(f)
+
+def _sample(base, sim, simulation, compiled, strategy, name, runs):
+    labels = [r["label"] for r in sim["reports"]]
+    seeds = [run_seed(2, name, simulation_label(simulation, sim), i) for i in range(runs)]
+    counts = {}
+    for reports in run_simulations(base, sim, simulation, compiled, strategy, seeds):
+        outcome = tuple(tuple(reports[label]) for label in labels)
+        counts[outcome] = counts.get(outcome, 0) + 1
+    return counts
+
+def test_exact_matches_sampling():
+    # every outcome's exact probability should be within a few standard
+    # errors of how often a large seeded sample comes out that way
+    base = _load("bases/jot-3.1.1.json")
+    sim = _load("sims/jot-combo.json")
+    (name, choices) = generate.GeneratedChoices(base, 1, 0, sim["end-states"])[0]
+    compiled = CompiledBase(base).compile_choices(choices)
+    runs = 4000
+    for simulation in sim["simulations"][1:3]:
+        strategy = get_sim(simulation, compiled.compiled_base)
+        outcomes = ExactSimulation(compiled, sim, strategy).run()
+        assert outcomes is not None
+        assert math.isclose(sum(outcomes.values()), 1.0)
+        counts = _sample(base, sim, simulation, compiled, strategy, name, runs)
+        for outcome in set(outcomes) | set(counts):
+            p = outcomes.get(outcome, 0.0)
+            assert p > 0
+            error = math.sqrt(p * (1 - p) / runs)
+            assert abs(counts.get(outcome, 0) / runs - p) <= 4 * error + 1e-9
+
+def test_exact_all_weights_zero():
+    # weighted_choice takes the last option when every weight is 0, so the
+    # exact engine should follow that one path with probability 1
+    base = _load("bases/jot-3.1.1.json")
+    sim = _load("sims/jot-combo.json")
+    (name, choices) = generate.GeneratedChoices(base, 1, 0, sim["end-states"])[0]
+    compiled = CompiledBase(base).compile_choices(choices)
+    simulation = {"type": "weighted-random", "label": "Zero", "weights": {u: 0 for u in base["unlockables"]}}
+    sim = dict(sim, simulations=[simulation])
+    strategy = get_sim(simulation, compiled.compiled_base)
+    outcomes = ExactSimulation(compiled, sim, strategy).run()
+    counts = _sample(base, sim, simulation, compiled, strategy, name, 20)
+    assert len(counts) == 1
+    assert outcomes == {outcome: 1.0 for outcome in counts}
@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from randosim.output import NpzRunWriter, load_runs
+
+def test_report_bits_round_trip(tmp_path):
+    # more categories than fit in a 64-bit mask, over several chunks
+    categories = ["cat%d" % k for k in range(70)]
+    sim = {"simulations": [{"label": "s"}],
+           "reports": [{"label": "wide", "categories": {c: {} for c in categories}},
+                       {"label": "narrow", "categories": {"x": {}, "y": {}, "z": {}}}]}
+    unlockables = ["u%d" % i for i in range(5)]
+    rng = random.Random(0)
+    runs = []
+    path = str(tmp_path / "runs.npz")
+    writer = NpzRunWriter(path, sim, unlockables, ["c.json"], chunk_rows=7)
+    for run in range(30):
+        choices = rng.sample(unlockables, rng.randrange(1, 6))
+        reports = {"seed": rng.getrandbits(64), "choices": choices, "choice_count": len(choices),
+                   "wide": rng.sample(categories, rng.randrange(71)), "narrow": rng.sample(["x", "y", "z"], rng.randrange(4))}
+        writer.add(0, 0, run, reports)
+        runs.append(reports)
+    writer.close()
+
+    (metadata, columns) = load_runs(path)
+    assert metadata["chunks"] == 5
+    assert columns["run"].tolist() == list(range(30))
+    assert columns["seed"].tolist() == [r["seed"] for r in runs]
+    offsets = columns["choice_offsets"].tolist()
+    for (n, report) in enumerate(metadata["reports"]):
+        bits = np.unpackbits(columns["report_%d" % n], axis=1, bitorder='little')
+        for (i, reports) in enumerate(runs):
+            matched = [c for (k, c) in enumerate(report["categories"]) if bits[i, k]]
+            assert matched == [c for c in report["categories"] if c in reports[report["label"]]]
+            assert not bits[i, len(report["categories"]):].any()
+    for (i, reports) in enumerate(runs):
+        assert [unlockables[c] for c in columns["choices"][offsets[i]:offsets[i + 1]]] == reports["choices"]
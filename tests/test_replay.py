@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from randosim import generate
+from randosim.output import NpzRunWriter
+from randosim.parse_file import parse_file
+from randosim.replay import replay
+from randosim.simulation import RandomizerSimulator, choices_names
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load(path):
+    with open(os.path.join(ROOT, path)) as f:
+        return parse_file(f)
+
+def test_replay_matches_analyze(tmp_path):
+    # replaying traced runs with the same sim file should give back exactly
+    # the summaries analyze worked out while simulating them
+    base = _load("bases/jot-3.1.1.json")
+    sim = _load("sims/jot-combo.json")
+    for simulation in sim["simulations"]:
+        simulation["count"] = 50
+    # one category per findable, so the order they're found in shows
+    sim["reports"].append({"label": "Every Findable", "type": "qualitative",
+                           "categories": {f: {"type": "got-findable", "findable": f} for f in reversed(list(base["findables"].keys()))}})
+    sources = list(generate.GeneratedChoices(base, 2, 0, sim["end-states"]))
+    path = str(tmp_path / "runs.npz")
+    writer = NpzRunWriter(path, sim, list(base["unlockables"].keys()), choices_names(sources), trace=True)
+    simulator = RandomizerSimulator(sources, base, sim, opts={"seed": 5, "trace": True}, output=writer)
+    simulator.run()
+    writer.close()
+
+    replayed = replay([path], sim)
+    assert replayed["summary"] == simulator.reports["summary"]
+    for (s, reports) in simulator.reports["simulations"].items():
+        assert replayed["simulations"][s]["summary"] == reports["summary"]
+    for (f, reports) in simulator.reports["files"].items():
+        assert replayed["files"][f]["summary"] == reports["summary"]
+        for (s, simulation_reports) in reports["simulations"].items():
+            assert replayed["files"][f]["simulations"][s]["summary"] == simulation_reports["summary"]